@@ -0,0 +1,79 @@
+import time
+
+import numpy as np
+
+from bounds import verify_tables, normalize_rows, VERIFY_CHUNK
+from lake import SatoLake
+from result_cache import cached_search
+from search_result import SearchResult
+
+
+class ANNSearcher(object):
+    ''' Search over a data lake through an approximate nearest neighbor index of its columns.
+
+    The index proposes candidate tables for the query columns, which are then verified with exact
+    matching. Subclasses (HNSWSearcher, LSHSearcher) set self.tables (a ColumnStore), self.solver,
+    self.cache and self._satoLake, and implement _find_candidates(query_cols, N).
+    '''
+
+    @cached_search
+    def topk(self, enc, query, K, N=5, threshold=0.6, time_budget=None):
+        # Note: N is the number of columns retrieved from the index
+        # time_budget: if set, search time in seconds. Candidates are verified in order of their number of
+        # index hits until the budget runs out, and the scores come back as a SearchResult with an `exact` flag.
+        deadline = None if time_budget is None else time.time() + time_budget
+        query_cols = []
+        for col in query[1]:
+            query_cols.append(col)
+        candidates = self._find_candidates(query_cols, N)
+        space = self._search_space(enc, query)
+        if deadline is None:
+            scores = self._score_candidates(space, candidates, threshold)
+        else:
+            scores = []
+            exact = True
+            # the first chunk holds the candidates with the most index hits: it is always verified
+            for start in range(0, len(candidates), VERIFY_CHUNK):
+                if scores and time.time() > deadline:
+                    exact = False
+                    break
+                scores += self._score_candidates(space, candidates[start:start + VERIFY_CHUNK], threshold)
+        scores.sort(reverse=True)
+        scoreLength = len(scores)
+        if deadline is not None:
+            return SearchResult(scores[:K], exact), scoreLength
+        return scores[:K], scoreLength
+
+    def _find_candidates(self, query_cols, N):
+        ''' Indices of the candidate tables of the query columns, in verification order
+        '''
+        raise NotImplementedError
+
+    def _search_space(self, enc, query):
+        ''' What the query is matched against for the given encoder (see NaiveSearcher._search_space)
+        Return:
+            (store, normalized query columns, scale, shift): the score of table i is scale[i] * matching + shift[i]
+        '''
+        if enc == 'sato':
+            satoLake = self._sato_lake()
+            scale, shift = satoLake.score_map(query[1])
+            return satoLake.sherlock, normalize_rows(satoLake.split_query(query[1])[0]), scale, shift
+        return self.tables, normalize_rows(query[1]), np.ones(len(self.tables)), np.zeros(len(self.tables))
+
+    def _score_candidates(self, space, candidates, threshold):
+        ''' (score, table name) pairs of the candidate tables (indices into self.tables)
+        '''
+        store, queryCols, scale, shift = space
+        tScores = verify_tables(queryCols, store, candidates, threshold, solver=self.solver, normalized=True)
+        return [(scale[tid] * score + shift[tid], self.tables.names[tid]) for score, tid in zip(tScores, candidates)]
+
+    def _rank_tables(self, hitTables):
+        ''' Indices of the tables hit by the index, most hits first (ties by table index)
+        '''
+        tids, counts = np.unique(hitTables, return_counts=True)
+        return tids[np.argsort(-counts, kind='stable')].tolist()
+
+    def _sato_lake(self):
+        if self._satoLake is None:
+            self._satoLake = SatoLake(self.tables)
+        return self._satoLake
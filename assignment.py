@@ -0,0 +1,173 @@
+import numpy as np
+
+from munkres import Munkres, make_cost_matrix, DISALLOWED
+from scipy.optimize import linear_sum_assignment
+
+
+def _munkres_score(graph):
+    ''' Reference solver: the pure-Python Munkres implementation used by the original verify()
+    '''
+    score = 0.0
+    max_graph = make_cost_matrix(graph, lambda cost: (graph.max() - cost) if (cost != DISALLOWED) else DISALLOWED)
+    m = Munkres()
+    indexes = m.compute(max_graph)
+    for row,col in indexes:
+        score += graph[row,col]
+    return score
+
+
+def _scipy_score(graph):
+    ''' Vectorized shortest augmenting path (Jonker-Volgenant style) solver from scipy
+    '''
+    rows, cols = linear_sum_assignment(-graph)
+    return float(graph[rows, cols].sum())
+
+
+SOLVERS = {
+    'munkres': _munkres_score,
+    'scipy': _scipy_score,
+}
+DEFAULT_SOLVER = 'scipy'
+# Graphs with at least this many rows and columns are solved one connected component at a time.
+# Labeling the components costs more than scipy's solver on graphs of data lake table size, so
+# only the pure-Python reference solver decomposes.
+DECOMPOSE_MIN_SIZE = {
+    'munkres': 8,
+}
+# Largest smaller side (# rows or # columns) of the graphs that batch_max_weight_matching solves
+# together with a vectorized subset DP instead of one solver call per graph; past it the DP's
+# 2^size states cost more than a call to the solver. Solvers not listed are never batched.
+BATCH_MAX_SIZE = {
+    'scipy': 5,
+}
+
+
+def get_solver(name):
+    ''' Look up an assignment solver by name
+    Args:
+        name (str): one of the keys of SOLVERS
+    Return:
+        function mapping a similarity graph to its maximum matching score
+    '''
+    if name not in SOLVERS:
+        raise ValueError("Unknown assignment solver '%s', choose one of %s" % (name, sorted(SOLVERS)))
+    return SOLVERS[name]
+
+
+def graph_components(graph):
+    ''' Split a bipartite similarity graph into its connected components
+    Args:
+        graph (numpy array): (# rows, # cols) similarities, 0 where there is no edge
+    Return:
+        list of (row indices, col indices), one per component with at least one edge
+    '''
+    edges = graph > 0
+    nrow = graph.shape[0]
+    # label propagation: every node ends up with the smallest row index of its component
+    labels = np.arange(nrow)
+    while True:
+        colLabels = np.where(edges, labels[:, None], nrow).min(axis=0)
+        newLabels = np.minimum(labels, np.where(edges, colLabels[None, :], nrow).min(axis=1))
+        if (newLabels == labels).all():
+            break
+        labels = newLabels
+    components = []
+    for label in np.unique(labels[edges.any(axis=1)]):
+        components.append((np.flatnonzero(labels == label), np.flatnonzero(colLabels == label)))
+    return components
+
+
+def max_weight_matching(graph, solver=DEFAULT_SOLVER):
+    ''' Score of the maximum weight bipartite matching of a similarity graph
+        Rows and columns without an edge are dropped. If a single row or column is left, the best
+        edge is the answer and the solver is not called. With a solver listed in DECOMPOSE_MIN_SIZE,
+        larger graphs are solved one connected component at a time. The score is the same as
+        solving the full graph.
+    Args:
+        graph (numpy array): (# query columns, # table columns) similarities, 0 where there is no edge
+        solver (str): name of the assignment backend, see SOLVERS
+    Return:
+        sum of the similarities of the matched column pairs
+    '''
+    solve = get_solver(solver)
+    graph = np.asarray(graph)
+    if graph.size == 0:
+        return 0.0
+    if graph.min() < 0:
+        # negative edges (threshold < 0) are forced into the full assignment, so it does not decompose
+        return solve(graph)
+    rowHit = graph.any(axis=1)
+    colHit = graph.any(axis=0)
+    numRows = np.count_nonzero(rowHit)
+    numCols = np.count_nonzero(colHit)
+    if numRows == 0:
+        return 0.0
+    if numRows == 1 or numCols == 1:
+        return float(graph.max())
+    if solver not in DECOMPOSE_MIN_SIZE or min(numRows, numCols) < DECOMPOSE_MIN_SIZE[solver]:
+        return solve(graph)
+    graph = graph[rowHit][:, colHit]
+    score = 0.0
+    for rows, cols in graph_components(graph):
+        if len(rows) == 1 or len(cols) == 1:
+            score += float(graph[np.ix_(rows, cols)].max())
+        else:
+            score += solve(graph[np.ix_(rows, cols)])
+    return score
+
+
+def _subset_dp(graphs):
+    ''' Exact maximum weight matching of a stack of same-shape non-negative graphs, all solved at once:
+        dp[:, mask] is the best score of matching the rows seen so far to the set of columns in mask
+    '''
+    numGraphs, nrow, ncol = graphs.shape
+    if ncol > nrow:
+        graphs = graphs.transpose(0, 2, 1)
+        nrow, ncol = ncol, nrow
+    masks = np.arange(1 << ncol)
+    withoutCol = [masks[(masks >> j) & 1 == 0] for j in range(ncol)]
+    dp = np.full((numGraphs, 1 << ncol), -np.inf)
+    dp[:, 0] = 0.0
+    for i in range(nrow):
+        newDp = dp.copy()
+        for j in range(ncol):
+            target = withoutCol[j] | (1 << j)
+            newDp[:, target] = np.maximum(newDp[:, target], dp[:, withoutCol[j]] + graphs[:, i, j][:, None])
+        dp = newDp
+    return dp.max(axis=1)
+
+
+def batch_max_weight_matching(graphs, solver=DEFAULT_SOLVER):
+    ''' Maximum weight matching scores of a stack of same-shape similarity graphs
+        Same scores as max_weight_matching on each graph. Graphs with at most one row or column with
+        edges are resolved for the whole stack at once, and with a solver listed in BATCH_MAX_SIZE
+        the others are solved together by a vectorized DP when they are small enough.
+    Args:
+        graphs (numpy array): (# graphs, # query columns, # table columns) similarities, 0 where there is no edge
+        solver (str): name of the assignment backend, see SOLVERS
+    Return:
+        numpy array with the score of each graph
+    '''
+    graphs = np.asarray(graphs)
+    numGraphs, nrow, ncol = graphs.shape
+    scores = np.zeros(numGraphs)
+    if graphs.size == 0:
+        return scores
+    if solver not in BATCH_MAX_SIZE or graphs.min() < 0:
+        for idx in range(numGraphs):
+            scores[idx] = max_weight_matching(graphs[idx], solver)
+        return scores
+    numRows = graphs.any(axis=2).sum(axis=1)
+    numCols = graphs.any(axis=1).sum(axis=1)
+    trivial = (numRows <= 1) | (numCols <= 1)
+    scores[trivial] = graphs[trivial].max(axis=(1, 2))
+    rest = np.flatnonzero(~trivial)
+    if len(rest) == 0:
+        return scores
+    if min(nrow, ncol) <= BATCH_MAX_SIZE[solver]:
+        scores[rest] = _subset_dp(graphs[rest])
+    else:
+        solve = get_solver(solver)
+        for idx in rest:
+            scores[idx] = solve(graphs[idx])
+    return scores
@@ -3,8 +3,16 @@ import numpy as np
 import random
 import os
 
-from munkres import Munkres, make_cost_matrix, DISALLOWED
 from numpy.linalg import norm
+from assignment import max_weight_matching, batch_max_weight_matching, DEFAULT_SOLVER
+from lake import reduce_segments
+
+
+# Slack added to upper bounds before pruning: a bound computed from a large matrix multiply
+# can round differently than the exact score computed for a single table
+BOUND_TOLERANCE = 1e-6
+# Number of candidate tables verified together between two checks of a search's time budget
+VERIFY_CHUNK = 32
 
 
 def cosine_sim(vec1, vec2):
@@ -12,22 +20,189 @@ def cosine_sim(vec1, vec2):
     return np.dot(vec1, vec2) / (norm(vec1)*norm(vec2))
 
 
-def verify(table1, table2, threshold=0.6):
-    score = 0.0
-    nrow = len(table1)
-    ncol = len(table2)
-    graph = np.zeros(shape=(nrow,ncol),dtype=float)
-    for i in range(nrow):
-        for j in range(ncol):
-            sim = cosine_sim(table1[i],table2[j])
-            if sim > threshold:
-                graph[i,j] = sim
-    max_graph = make_cost_matrix(graph, lambda cost: (graph.max() - cost) if (cost != DISALLOWED) else DISALLOWED)
-    m = Munkres()
-    indexes = m.compute(max_graph)
-    for row,col in indexes:
-        score += graph[row,col]
-    return score
+def normalize_rows(vectors):
+    '''
+    Scale every row of a 2-d array to unit L2 norm. Rows with zero norm are left as zeros,
+    so they have zero similarity to everything instead of producing NaNs.
+    '''
+    vectors = np.asarray(vectors)
+    norms = norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def similarity_graph(table1, table2, threshold, normalized=False):
+    '''
+    Build the thresholded cosine similarity graph between the columns of two tables
+    with a single matrix multiply
+    Args:
+        table1 (numpy array): the vectors of the query (# rows: # columns in a table, #cols: dimension of embedding)
+        table2 (numpy array): similar to table1, set of column vectors of the data lake table
+        threshold (float): minimum cosine similarity to include an edge
+        normalized (bool): set if the rows of both tables already have unit norm
+    Return:
+        dense (len(table1), len(table2)) array holding the similarity of every edge above the threshold and 0 elsewhere
+    '''
+    if not normalized:
+        table1 = normalize_rows(table1)
+        table2 = normalize_rows(table2)
+    graph = np.dot(table1, table2.T)
+    graph[graph <= threshold] = 0.0
+    return graph
+
+
+def _sorted_edges(graph):
+    # edges of the graph by decreasing (sim, i, j), the order used by the bounds
+    rows, cols = np.nonzero(graph)
+    sims = graph[rows, cols]
+    order = np.lexsort((-cols, -rows, -sims))
+    return sims[order], rows[order], cols[order]
+
+
+def graph_edges(graph):
+    '''
+    Turn a similarity graph into the list of its edges sorted by decreasing similarity
+    Return:
+        list of (sim, i, j) edges and the sets of row and column nodes touched by an edge
+    '''
+    sims, rows, cols = _sorted_edges(graph)
+    edges = list(zip(sims.tolist(), rows.tolist(), cols.tolist()))
+    return edges, set(rows.tolist()), set(cols.tolist())
+
+
+def matching_bounds(graph):
+    '''
+    Lower and upper bound of the bipartite matching score of a similarity graph, from one sorted edge array
+    Upper bound: the sum of the heaviest edges until every node of one side is touched (same as upper_bound_bm)
+    Lower bound: the score of the greedy matching (same as lower_bound_bm)
+    Unlike calling lower_bound_bm and upper_bound_bm on the node sets of get_edges, the two bounds do not
+    share any bookkeeping, so each one is valid on its own.
+    Args:
+        graph (numpy array): thresholded similarity graph, see similarity_graph
+    Return:
+        (lower bound, upper bound) with lower bound <= exact score <= upper bound
+    '''
+    sims, rows, cols = _sorted_edges(graph)
+    if len(sims) == 0:
+        return 0.0, 0.0
+    # position in the sorted edges at which each node is first touched
+    _, firstRow = np.unique(rows, return_index=True)
+    _, firstCol = np.unique(cols, return_index=True)
+    ub = float(sims[:min(firstRow.max(), firstCol.max()) + 1].sum())
+
+    maxMatched = min(len(firstRow), len(firstCol))
+    usedRows = np.zeros(graph.shape[0], dtype=bool)
+    usedCols = np.zeros(graph.shape[1], dtype=bool)
+    lb = 0.0
+    matched = 0
+    for sim, i, j in zip(sims.tolist(), rows.tolist(), cols.tolist()):
+        if not usedRows[i] and not usedCols[j]:
+            usedRows[i] = usedCols[j] = True
+            lb += sim
+            matched += 1
+            if matched == maxMatched:
+                break
+    return lb, ub
+
+
+def verify(table1, table2, threshold=0.6, normalized=False, solver=DEFAULT_SOLVER):
+    graph = similarity_graph(table1, table2, threshold, normalized)
+    return max_weight_matching(graph, solver)
+
+def verify_tables(query, store, table_ids, threshold, solver=DEFAULT_SOLVER, normalized=False, chunk_size=1 << 22):
+    '''
+    Exact matching scores of the query against many tables of the lake, the same scores as verify() on each
+    Tables are grouped by column count. For each group, the (table, query column, table column) similarity
+    tensor comes from one stacked matrix multiply and all the assignments are solved together.
+    Args:
+        query (numpy array): query column vectors
+        store (ColumnStore): the data lake
+        table_ids (sequence): indices of the tables to verify (removed tables are skipped and score -inf)
+        threshold (float): minimum cosine similarity to include an edge
+        solver (str): name of the assignment backend, see assignment.SOLVERS
+        normalized (bool): set if the query rows already have unit norm
+        chunk_size (int): maximum number of gathered vector entries per matrix multiply
+    Return:
+        numpy array with the score of each table in table_ids
+    '''
+    if not normalized:
+        query = normalize_rows(query)
+    # the products are promoted like verify()'s, so every edge is kept or dropped by the threshold exactly as there
+    query = np.asarray(query)
+    table_ids = np.asarray(table_ids, dtype=np.int64)
+    scores = np.zeros(len(table_ids))
+    dead = store.deleted[table_ids]
+    scores[dead] = -np.inf
+    counts = store.column_counts()[table_ids]
+    for count in np.unique(counts[~dead]):
+        if count == 0:
+            continue
+        members = np.flatnonzero((counts == count) & ~dead)
+        step = max(1, chunk_size // (int(count) * store.dim))
+        for start in range(0, len(members), step):
+            part = members[start:start + step]
+            rows = store.offsets[table_ids[part]][:, None] + np.arange(count)
+            # a stacked matmul runs the same product for every table, so a table's similarities do not
+            # depend on which other tables share its chunk (einsum's contraction order does)
+            graphs = np.matmul(store.vectors[rows], query.T).transpose(0, 2, 1)
+            graphs[graphs <= threshold] = 0.0
+            scores[part] = batch_max_weight_matching(graphs, solver)
+    return scores
+
+
+# Cheap whole-lake table scores computed by lake_table_scores
+LAKE_SCORERS = ('bound', 'colmax')
+
+
+def lake_table_scores(query, store, threshold, scorer='bound', block_size=65536):
+    '''
+    Cheap scores of the query against every table of the lake at once, to rank tables before exact matching
+    'colmax' is the sum over query columns of their best edge in the table. 'bound' is the smaller of that
+    and the sum over table columns of their best edge to the query (see lake_upper_bounds).
+    Args:
+        query (numpy array): unit-norm query column vectors
+        store (ColumnStore): the data lake
+        threshold (float): minimum cosine similarity to include an edge
+        scorer (str): one of LAKE_SCORERS
+        block_size (int): number of lake columns multiplied at once
+    Return:
+        numpy array with one score per table of the store (-inf for removed tables)
+    '''
+    if scorer not in LAKE_SCORERS:
+        raise ValueError("Unknown table scorer '%s', choose one of %s" % (scorer, list(LAKE_SCORERS)))
+    scores = np.zeros(len(store))
+    offsets = store.offsets
+    for start, stop in store.blocks(block_size):
+        sims = np.dot(query, store.vectors[offsets[start]:offsets[stop]].T)
+        sims[sims <= max(threshold, 0.0)] = 0.0
+        tOffsets = offsets[start:stop + 1] - offsets[start]
+        rowBound = reduce_segments(np.maximum, sims, tOffsets, axis=1).sum(axis=0)
+        if scorer == 'colmax':
+            scores[start:stop] = rowBound
+        else:
+            colBound = reduce_segments(np.add, sims.max(axis=0, initial=0.0), tOffsets)
+            scores[start:stop] = np.minimum(rowBound, colBound)
+    scores[store.deleted] = -np.inf
+    return scores
+
+
+def lake_upper_bounds(query, store, threshold, block_size=65536):
+    '''
+    Upper bound on the bipartite matching score of the query against every table of the lake at once
+    A matching uses each query column and each table column at most once, so its score is at most the
+    sum over query columns of their best edge in the table, and at most the sum over table columns of
+    their best edge to the query. Both sums come from one matrix multiply per block of lake columns and
+    segmented reductions over the table offsets.
+    Args:
+        query (numpy array): unit-norm query column vectors
+        store (ColumnStore): the data lake
+        threshold (float): minimum cosine similarity to include an edge
+        block_size (int): number of lake columns multiplied at once
+    Return:
+        numpy array with one upper bound per table of the store (-inf for removed tables)
+    '''
+    return lake_table_scores(query, store, threshold, 'bound', block_size)
+
 
 def upper_bound_bm(edges, nodes1, nodes2):
     '''
@@ -62,27 +237,15 @@ def lower_bound_bm(edges, nodes1, nodes2):
     return score
 
 
-def get_edges(table1, table2, threshold):
+def get_edges(table1, table2, threshold, normalized=False):
     '''
     Generate the similarity graph used by lower bounds and upper bounds
     Args:
         table1 (numpy array): the vectors of the query (# rows: # columns in a table, #cols: dimension of embedding)
         table2 (numpy array): similar to table1, set of column vectors of the data lake table
         threshold (float): minimum cosine similarity to include an edge
+        normalized (bool): set if the rows of both tables already have unit norm
     Return:
         list of edges and sets of nodes used in lower and upper bounds calculations
     '''
-    nrow = len(table1)
-    ncol = len(table2)
-    edges = []
-    nodes1 = set()
-    nodes2 = set()
-    for i in range(nrow):
-        for j in range(ncol):
-            sim = cosine_sim(table1[i],table2[j])
-            if sim > threshold:
-                edges.append((sim,i,j))
-                nodes1.add(i)
-                nodes2.add(j)
-    edges.sort(reverse=True)
-    return edges, nodes1, nodes2
\ No newline at end of file
+    return graph_edges(similarity_graph(table1, table2, threshold, normalized))
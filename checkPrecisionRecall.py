@@ -28,6 +28,22 @@ def saveDictionaryAsPickleFile(dictionary, dictionaryPath):
     filePointer.close()
 
 
+def calcRecallVsExact(resultFile, exactFile):
+    ''' Average recall of a search against exact search over the same queries
+    Args:
+        resultFile: dictionary mapping each query to the list of tables the search returned
+        exactFile: dictionary mapping each query to the top-K tables of exact search
+    Return: mean over queries of the fraction of the exact top-K that the search also returned
+    '''
+    recalls = []
+    for query, exact in exactFile.items():
+        if len(exact) == 0:
+            continue
+        returned = set(resultFile.get(query, []))
+        recalls.append(sum(1 for table in exact if table in returned) / len(exact))
+    return float(np.mean(recalls)) if recalls else 1.0
+
+
 def calcMetrics(max_k, k_range, resultFile, gtPath=None, resPath=None, record=True, verbose=False):
     '''Calculate and log the performance metrics, both system-wide and per-query
     Args:
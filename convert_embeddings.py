@@ -0,0 +1,49 @@
+import argparse
+import pickle
+import time
+
+from lake import ColumnStore, store_path, SATO_SHERLOCK_DIM
+
+
+def convert(pkl_path, output_path=None, **meta):
+    ''' Convert a pickled list of (table name, column vectors) pairs into a column store
+    Args:
+        pkl_path: the pickle written by extractVectors.py
+        output_path: the store directory (defaults to the pickle path with a .lake suffix)
+        meta: extra metadata for the store header (e.g. encoder='cl')
+    Return:
+        path of the written store
+    '''
+    if output_path is None:
+        output_path = store_path(pkl_path)
+    start_time = time.time()
+    tfile = open(pkl_path,"rb")
+    tables = pickle.load(tfile)
+    tfile.close()
+    store = ColumnStore.from_tables(tables)
+    store.save(output_path, source=str(pkl_path), **meta)
+    print("%s -> %s: %d tables, %d columns, dim %d (%.2f seconds)"
+          % (pkl_path, output_path, len(store), store.num_columns, store.dim, time.time() - start_time))
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert pickled embeddings into memory-mappable column stores")
+    parser.add_argument("pickles", nargs="+", help="pickle files written by extractVectors.py")
+    parser.add_argument("--output", type=str, default=None,
+                        help="output store directory (only with a single input; defaults to <pickle>.lake)")
+    parser.add_argument("--encoder", type=str, default=None, help="encoder recorded in the store header")
+    parser.add_argument("--sherlock_dim", type=int, default=None,
+                        help="size of the Sherlock part of 'sato' vectors (default %d for --encoder sato)" % SATO_SHERLOCK_DIM)
+    hp = parser.parse_args()
+
+    if hp.output is not None and len(hp.pickles) > 1:
+        parser.error("--output can only be used with a single input pickle")
+    meta = {}
+    if hp.encoder is not None:
+        meta["encoder"] = hp.encoder
+    if hp.encoder == "sato" or hp.sherlock_dim is not None:
+        # where the Sherlock features end and the topic vector starts (see lake.SatoLake)
+        meta["sherlock_dim"] = hp.sherlock_dim if hp.sherlock_dim is not None else SATO_SHERLOCK_DIM
+    for pkl_path in hp.pickles:
+        convert(pkl_path, hp.output, **meta)
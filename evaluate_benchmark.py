@@ -4,8 +4,10 @@ import pickle
 import numpy as np
 from pathlib import Path
 from scipy.spatial.distance import cosine, euclidean
-from checkPrecisionRecall import calcMetrics, loadDictionaryFromPickleFile
+from checkPrecisionRecall import calcMetrics
 from naive_search import NaiveSearcher
+from result_cache import ResultCache
+from lake import load_tables, is_store, store_path
 from tqdm import tqdm
 import pandas as pd
 
@@ -27,14 +29,19 @@ def load_embeddings(benchmark, variant):
         query_path = base_path / "starmie_query_embeddings.pkl"
         datalake_path = base_path / f"starmie_{variant}_datalake_embeddings.pkl"
         
-        queries = loadDictionaryFromPickleFile(query_path)
-        datalake = loadDictionaryFromPickleFile(datalake_path)
+        # a memory-mapped column store next to the pickle is used when available
+        queries = load_tables(query_path)
+        datalake = load_tables(datalake_path)
         
         return queries, datalake
     except FileNotFoundError as e:
         print(f"Warning: Could not load embeddings for {benchmark}/{variant}: {e}")
         return None, None
 
+def has_embeddings(path):
+    """Whether embeddings exist at path, either pickled or as a column store"""
+    return path.exists() or is_store(store_path(path))
+
 def load_table_structure(table_path):
     """Load CSV table to get column names and order"""
     try:
@@ -118,8 +125,8 @@ def calculate_detailed_similarity_metrics(original_embeddings, variant_embedding
     
     return detailed_metrics
 
-def evaluate_benchmark(benchmark_name, distances_only=False):
-    """Main evaluation function for a benchmark"""
+def evaluate_benchmark(benchmark_name, distances_only=False, cache_dir=None):
+    """Main evaluation function for a benchmark (search results are cached in cache_dir if given)"""
     # Parameters from run_tus_all.py and test_naive_search.py
     params = {
         'santos': {
@@ -176,8 +183,8 @@ def evaluate_benchmark(benchmark_name, distances_only=False):
                 original_path = base_path / "starmie_original_datalake_embeddings.pkl"
                 variant_path = base_path / f"starmie_{variant}_datalake_embeddings.pkl"
                 
-                original_datalake = loadDictionaryFromPickleFile(original_path)
-                variant_datalake = loadDictionaryFromPickleFile(variant_path)
+                original_datalake = load_tables(original_path)
+                variant_datalake = load_tables(variant_path)
                 
                 detailed_metrics = calculate_detailed_similarity_metrics(
                     original_datalake, 
@@ -200,22 +207,24 @@ def evaluate_benchmark(benchmark_name, distances_only=False):
     variants = ['original','p-col']
 
     results = {}
+    # one cache for all variants: entries are keyed by the content of each variant's data lake
+    cache = ResultCache(cache_dir=cache_dir) if cache_dir else None
     
     for variant in variants:
         datalake_path = base_path / f"starmie_{variant}_datalake_embeddings.pkl"
         query_path = base_path / "starmie_query_embeddings.pkl"
         
-        if not datalake_path.exists() or not query_path.exists():
+        if not has_embeddings(datalake_path) or not has_embeddings(query_path):
             print(f"Skipping {variant}: embeddings not found")
             continue
         
         # Do the search first
-        searcher = NaiveSearcher(str(datalake_path), scale=params['scale'])
+        searcher = NaiveSearcher(str(datalake_path), scale=params['scale'], cache=cache)
         returnedResults = {}
         unionability_scores = {}  # New temporary dictionary to store scores
         
         # Load queries and sample if needed
-        queries = loadDictionaryFromPickleFile(query_path)
+        queries = load_tables(query_path)
         queries.sort(key=lambda x: x[0])
         
         # Sample queries for tus and tusLarge
@@ -276,6 +285,10 @@ if __name__ == "__main__":
                        type=str,
                        default=None,
                        help="Optional: Override default data directory path")
+    parser.add_argument("--cache_dir",
+                       type=str,
+                       default=None,
+                       help="Optional: Directory of the persistent search result cache shared across runs")
     
     args = parser.parse_args()
     
@@ -283,4 +296,4 @@ if __name__ == "__main__":
     if args.data_dir:
         data_path = Path(args.data_dir)
     
-    evaluate_benchmark(args.benchmark, args.distances_only)
\ No newline at end of file
+    evaluate_benchmark(args.benchmark, args.distances_only, args.cache_dir)
\ No newline at end of file
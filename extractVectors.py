@@ -11,6 +11,7 @@ from tqdm import tqdm
 import os
 import json
 import transformers
+from lake import ColumnStore, store_path
 
 transformers.logging.set_verbosity_error()
 
@@ -145,6 +146,8 @@ if __name__ == '__main__':
     parser.add_argument("--save_model", dest="save_model", action="store_true")
     parser.add_argument("--return_serialized", dest="return_serialized", action="store_true", 
                        help="Whether to return and save serialized table strings")
+    parser.add_argument("--save_format", type=str, default="both", choices=['both', 'pkl', 'store'],
+                       help="Save vectors as a pickle, a memory-mappable column store (<name>.lake), or both")
 
     hp = parser.parse_args()
 
@@ -234,7 +237,13 @@ if __name__ == '__main__':
 
             if hp.save_model:
                 output_path = os.path.join(output_dir, f"cl_{ao}_{sm}_{table_order}_{run_id}.pkl")
-                pickle.dump(dataEmbeds, open(output_path, "wb"))
+                if hp.save_format in ['both', 'pkl']:
+                    pickle.dump(dataEmbeds, open(output_path, "wb"))
+                if hp.save_format in ['both', 'store']:
+                    ColumnStore.from_tables(dataEmbeds).save(
+                        store_path(output_path), encoder='cl', benchmark=dataFolder,
+                        augment_op=ao, sample_meth=sm, table_order=table_order,
+                        run_id=run_id, single_column=isSingleCol)
                 
                 # Save serialized strings if available
                 if hp.return_serialized:
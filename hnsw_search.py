@@ -1,26 +1,32 @@
 import numpy as np
-import random
-import pickle
 import time
 import hnswlib
 
-from munkres import Munkres, make_cost_matrix, DISALLOWED
-from numpy.linalg import norm
+from ann_search import ANNSearcher
+from lake import load_lake
+from assignment import DEFAULT_SOLVER
+from result_cache import ResultCache
 
 
-class HNSWSearcher(object):
+class HNSWSearcher(ANNSearcher):
     def __init__(self,
                  table_path,
                  index_path,
-                 scale
+                 scale,
+                 solver=DEFAULT_SOLVER,
+                 cache=None,
+                 seed=None
                  ):
-        tfile = open(table_path,"rb")
-        tables = pickle.load(tfile)
-        # For scalability experiments: load a percentage of tables
-        self.tables = random.sample(tables, int(scale*len(tables)))
-        print("From %d total data-lake tables, scale down to %d tables" % (len(tables), len(self.tables)))
-        tfile.close()
-        self.vec_dim = len(self.tables[1][1][0])
+        # assignment backend used for exact verification (see assignment.SOLVERS)
+        self.solver = solver
+        # ResultCache serving repeated searches (None: always search)
+        self.cache = cache
+        # load tables to be queried: a ColumnStore of unit-norm float32 column vectors
+        # seed: reproducible, nested table samples for scale < 1 (see lake.sample_tables)
+        self.tables = load_lake(table_path, scale, seed)
+        # Sherlock/topic split of the lake, built on the first query with encoder 'sato'
+        self._satoLake = None
+        self.vec_dim = self.tables.dim
 
         index_start_time = time.time()
         self.index = hnswlib.Index(space='cosine', dim=self.vec_dim)
@@ -38,69 +44,53 @@ class HNSWSearcher(object):
         #     # load index
         #     self.index.load_index(index_path, max_elements = len(self.all_columns))
     
-    def topk(self, enc, query, K, N=5, threshold=0.6):
-        # Note: N is the number of columns retrieved from the index
-        query_cols = []
-        for col in query[1]:
-            query_cols.append(col)
-        candidates = self._find_candidates(query_cols, N)
-        if enc == 'sato':
-            scores = []
-            querySherlock = query[1][:, :1187]
-            querySato = query[1][0, 1187:]
-            for table in candidates:
-                sherlock = table[1][:, :1187]
-                sato = table[1][0, 1187:]
-                sScore = self._verify(querySherlock, sherlock, threshold)
-                sherlockScore = (1/min(len(querySherlock), len(sherlock))) * sScore
-                satoScore = self._cosine_sim(querySato, sato)
-                score = sherlockScore + satoScore
-                scores.append((score, table[0]))
-        else: # encoder is sherlock
-            scores = [(self._verify(query[1], table[1], threshold), table[0]) for table in candidates]
-        scores.sort(reverse=True)
-        scoreLength = len(scores)
-        return scores[:K], scoreLength
-    
     def _preprocess_table_hnsw(self):
-        all_columns = []
-        col_table_ids = []
-        for idx,table in enumerate(self.tables):
-            for col in table[1]:
-                all_columns.append(col)
-                col_table_ids.append(idx)
-        return all_columns, col_table_ids
+        # the store already holds every column contiguously, ordered by table
+        return self.tables.vectors, self.tables.column_table_ids()
     
     def _find_candidates(self,query_cols, N):
-        table_subs = set()
         labels, _ = self.index.knn_query(query_cols, k=N)
-        for result in labels:
-            # result: list of subscriptions of column vector
-            for idx in result:
-                table_subs.add(self.col_table_ids[idx])
-        candidates = []
-        for tid in table_subs:
-            candidates.append(self.tables[tid])
-        return candidates
+        # result: list of subscriptions of column vector
+        return self._rank_tables(self.col_table_ids[np.asarray(labels).ravel()])
     
-    def _cosine_sim(self, vec1, vec2):
-        assert vec1.ndim == vec2.ndim
-        return np.dot(vec1, vec2) / (norm(vec1)*norm(vec2))
+    def add_tables(self, tables):
+        ''' Add tables to the data lake and insert their columns into the index
+        Args:
+            tables: list of (table name, column vectors) pairs
+        '''
+        tids = self.tables.add_tables(tables)
+        vectors = self.tables.vectors[self.tables.offsets[tids.start]:]
+        if len(vectors) > 0:
+            # labels are never reused: col_table_ids maps every label ever added to its table (-1 once removed)
+            labels = np.arange(len(self.col_table_ids), len(self.col_table_ids) + len(vectors))
+            if labels[-1] >= self.index.get_max_elements():
+                self.index.resize_index(max(labels[-1] + 1, 2 * self.index.get_max_elements()))
+            self.index.add_items(vectors, labels)
+            self.col_table_ids = np.concatenate([self.col_table_ids, np.repeat(np.array(tids), self.tables.column_counts()[tids.start:])])
+        self.all_columns = self.tables.vectors
+        self._satoLake = None
 
-    def _verify(self, table1, table2, threshold):
-        score = 0.0
-        nrow = len(table1)
-        ncol = len(table2)
-        graph = np.zeros(shape=(nrow,ncol),dtype=float)
-        for i in range(nrow):
-            for j in range(ncol):
-                sim = self._cosine_sim(table1[i],table2[j])
-                if sim > threshold:
-                    graph[i,j] = sim
+    def remove_tables(self, names):
+        ''' Remove the tables with the given names from the data lake and the index
+        Return:
+            the number of tables removed
+        '''
+        indices = self.tables.table_indices(names)
+        if len(indices) == 0:
+            return 0
+        remap = self.tables.remove_tables(indices)
+        valid = self.col_table_ids >= 0
+        newIds = np.where(valid, remap[np.where(valid, self.col_table_ids, 0)], -1)
+        removedLabels = np.flatnonzero(valid & (newIds < 0))
+        for label in removedLabels:
+            self.index.mark_deleted(int(label))
+        self.col_table_ids = newIds
+        self.all_columns = self.tables.vectors
+        return len(indices)
 
-        max_graph = make_cost_matrix(graph, lambda cost: (graph.max() - cost) if (cost != DISALLOWED) else DISALLOWED)
-        m = Munkres()
-        indexes = m.compute(max_graph)
-        for row,col in indexes:
-            score += graph[row,col]
-        return score
\ No newline at end of file
+    def cache_scope(self):
+        ''' What results depend on besides the call arguments: the lake, the index parameters and the solver
+            (the graph itself is not hashed)
+        '''
+        return ResultCache.key(type(self).__name__, self.tables.fingerprint(), self.index.space,
+                               self.index.M, self.index.ef_construction, self.index.ef, self.solver)
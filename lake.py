@@ -0,0 +1,531 @@
+import numpy as np
+import hashlib
+import json
+import os
+import pickle
+import random
+
+
+# On-disk layout of a column store directory (see ColumnStore.save)
+STORE_FORMAT = "starmie-column-store"
+STORE_VERSION = 1
+STORE_SUFFIX = ".lake"
+# 'sato' column vectors are a Sherlock part followed by a table-level topic vector. Stores record
+# the split point in meta["sherlock_dim"]; this is the size of the Sherlock features otherwise.
+SATO_SHERLOCK_DIM = 1187
+
+
+def array_fingerprint(array, hasher=None, block_rows=1 << 16):
+    ''' Content hash of a numpy array (dtype, shape and values), read in blocks of rows so
+        memory-mapped arrays are hashed without loading them at once
+    Args:
+        array (numpy array): the array to hash
+        hasher: hashlib object to update instead of a new sha1
+        block_rows (int): number of rows hashed at a time
+    Return:
+        hex digest (or the updated hasher if one was given)
+    '''
+    ownHasher = hasher is None
+    if ownHasher:
+        hasher = hashlib.sha1()
+    array = np.asarray(array)
+    hasher.update(("%s %s|" % (array.dtype.str, array.shape)).encode())
+    if array.ndim == 0:
+        hasher.update(array.tobytes())
+    for start in range(0, len(array) if array.ndim > 0 else 0, block_rows):
+        hasher.update(np.ascontiguousarray(array[start:start + block_rows]).tobytes())
+    return hasher.hexdigest() if ownHasher else hasher
+
+
+class ColumnStore(object):
+    ''' The column vectors of a data lake kept in one contiguous matrix.
+
+    Column vectors are stored row-normalized (unit L2 norm) in float32, so the
+    columns of a table are a zero-copy slice that can go straight to a matrix
+    multiply. The original norms are kept in `norms` for callers that need the
+    raw encoder output back.
+
+    Indexing and iteration yield (name, vectors) pairs, the same shape as the
+    pickled list of tables produced by extractVectors.py.
+    '''
+    def __init__(self, vectors, offsets, names, norms=None, meta=None, path=None, fingerprint=None, deleted=None):
+        '''
+        Args:
+            vectors (numpy array): (# columns in the lake, dim) unit-norm column vectors
+            offsets (numpy array): (# tables + 1,) table i owns rows offsets[i]:offsets[i+1]
+            names (sequence): table names, one per table
+            norms (numpy array): original L2 norm of each column vector (ones if omitted)
+            meta (dict): free-form metadata about the lake (e.g. the encoder)
+            path (str): the store directory when the arrays are backed by ColumnStore.open
+            fingerprint (str): content hash of the store if already known (see fingerprint())
+            deleted (numpy array): (# tables,) mask of the tables removed by remove_tables (none if omitted)
+        '''
+        self.vectors = vectors
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object)
+        if norms is None:
+            norms = np.ones(len(vectors), dtype=vectors.dtype)
+        self.norms = norms
+        self.meta = dict(meta) if meta else {}
+        self.path = path
+        self._fingerprint = fingerprint
+        # removed tables keep their rows until compact(); searches skip them (see live_tables)
+        if deleted is None:
+            deleted = np.zeros(len(self.names), dtype=bool)
+        self.deleted = np.asarray(deleted, dtype=bool)
+        # fingerprint of the content together with the removed tables, once computed
+        self._liveFingerprint = None
+        # (vectors, norms) arrays with room for more columns, of which self.vectors and self.norms are
+        # the used prefix; allocated by the first add_tables
+        self._buffers = None
+        assert len(self.offsets) == len(self.names) + 1
+        assert self.offsets[-1] == len(self.vectors)
+
+    @classmethod
+    def from_tables(cls, tables, dtype=np.float32, meta=None):
+        ''' Build a store from a list of (name, column vectors) pairs
+        '''
+        names = [table[0] for table in tables]
+        arrays = [np.asarray(table[1], dtype=dtype) for table in tables]
+        dim = next((a.shape[-1] for a in arrays if a.size > 0), 0)
+        arrays = [a.reshape(-1, dim) for a in arrays]
+        counts = np.array([len(a) for a in arrays], dtype=np.int64)
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if len(arrays) > 0:
+            vectors = np.concatenate(arrays, axis=0)
+        else:
+            vectors = np.zeros((0, dim), dtype=dtype)
+        norms = np.linalg.norm(vectors, axis=1).astype(dtype)
+        safe = norms.copy()
+        safe[safe == 0] = 1.0
+        vectors /= safe[:, None]
+        return cls(vectors, offsets, names, norms=norms, meta=meta)
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        ''' Open a store written by ColumnStore.save
+        Args:
+            path (str): the store directory
+            mmap (bool): memory-map the arrays read-only instead of reading them into memory
+        Return:
+            ColumnStore backed by the files in path
+        '''
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+        if header.get("format") != STORE_FORMAT:
+            raise ValueError("%s is not a column store" % path)
+        if header.get("version") != STORE_VERSION:
+            raise ValueError("Unsupported column store version %s in %s (expected %d)"
+                             % (header.get("version"), path, STORE_VERSION))
+        mmap_mode = 'r' if mmap else None
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode)
+        norms = np.load(os.path.join(path, "norms.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+        # the mask is updated in place by remove_tables: always read into memory
+        deleted = None
+        if os.path.exists(os.path.join(path, "deleted.npy")):
+            deleted = np.load(os.path.join(path, "deleted.npy"))
+        with open(os.path.join(path, "names.json")) as f:
+            names = json.load(f)
+        return cls(vectors, offsets, names, norms=norms, meta=header.get("meta"), path=path,
+                   fingerprint=header.get("fingerprint"), deleted=deleted)
+
+    def save(self, path, **meta):
+        ''' Write the store to a directory that ColumnStore.open can memory-map
+        Args:
+            path (str): the store directory (created if missing)
+            meta: extra metadata recorded in the header (e.g. encoder='cl')
+        '''
+        os.makedirs(path, exist_ok=True)
+        meta = dict(self.meta, **meta)
+        np.save(os.path.join(path, "vectors.npy"), np.ascontiguousarray(self.vectors))
+        np.save(os.path.join(path, "norms.npy"), np.ascontiguousarray(self.norms))
+        np.save(os.path.join(path, "offsets.npy"), self.offsets)
+        np.save(os.path.join(path, "deleted.npy"), self.deleted)
+        with open(os.path.join(path, "names.json"), "w") as f:
+            json.dump(self.names.tolist(), f)
+        header = {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "dim": int(self.dim),
+            "dtype": str(self.vectors.dtype),
+            "num_tables": len(self),
+            "num_columns": int(self.num_columns),
+            "normalized": True,
+            "fingerprint": self._content_fingerprint(),
+            "meta": meta,
+        }
+        # the header is written last so a store is only visible once complete
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump(header, f, indent=2)
+
+    def fingerprint(self):
+        ''' Hash of the lake: its content (see _content_fingerprint) and the tables removed from it
+        '''
+        if not self.deleted.any():
+            return self._content_fingerprint()
+        if self._liveFingerprint is None:
+            hasher = hashlib.sha1(self._content_fingerprint().encode())
+            array_fingerprint(np.flatnonzero(self.deleted), hasher)
+            self._liveFingerprint = hasher.hexdigest()
+        return self._liveFingerprint
+
+    def _content_fingerprint(self):
+        ''' Content hash of the lake: table names, column layout and vectors (metadata excluded)
+            Computed once; stores written by save() keep it in their header.
+        '''
+        if self._fingerprint is None:
+            hasher = hashlib.sha1()
+            hasher.update(json.dumps(self.names.tolist()).encode())
+            array_fingerprint(self.offsets, hasher)
+            array_fingerprint(self.vectors, hasher)
+            array_fingerprint(self.norms, hasher)
+            self._fingerprint = hasher.hexdigest()
+        return self._fingerprint
+
+    def to_tables(self):
+        ''' The lake as a list of (name, raw column vectors) pairs, like the pickled format (removed tables left out)
+        '''
+        return [(self.names[idx], self.raw(idx)) for idx in self.live_tables()]
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    @property
+    def num_columns(self):
+        return len(self.vectors)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return (self.names[idx], self.table(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def table(self, idx):
+        ''' Zero-copy view of the unit-norm column vectors of table idx
+        '''
+        return self.vectors[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def raw(self, idx):
+        ''' Column vectors of table idx as produced by the encoder (norms restored)
+        '''
+        start, stop = self.offsets[idx], self.offsets[idx + 1]
+        return self.vectors[start:stop] * self.norms[start:stop, None]
+
+    def live_tables(self):
+        ''' Indices of the tables that have not been removed
+        '''
+        return np.flatnonzero(~self.deleted)
+
+    def column_counts(self):
+        return np.diff(self.offsets)
+
+    def column_table_ids(self):
+        ''' Index of the owning table for every column vector
+        '''
+        return np.repeat(np.arange(len(self)), self.column_counts())
+
+    def blocks(self, block_size):
+        ''' Split the lake into contiguous ranges of tables holding about block_size columns each
+        Return:
+            generator of (first table, last table + 1) pairs
+        '''
+        start = 0
+        while start < len(self):
+            stop = np.searchsorted(self.offsets, self.offsets[start] + block_size, side='right') - 1
+            stop = min(max(stop, start + 1), len(self))
+            yield start, stop
+            start = stop
+
+    def slice(self, start, stop):
+        ''' Zero-copy store over the contiguous range of tables start:stop
+        '''
+        lo, hi = self.offsets[start], self.offsets[stop]
+        return ColumnStore(self.vectors[lo:hi], self.offsets[start:stop + 1] - lo, self.names[start:stop],
+                           norms=self.norms[lo:hi], meta=self.meta, deleted=self.deleted[start:stop])
+
+    def select(self, indices):
+        ''' New store holding only the tables at the given indices, in that order
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.column_counts()[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return ColumnStore(self.vectors[rows], offsets, self.names[indices],
+                           norms=self.norms[rows], meta=self.meta, deleted=self.deleted[indices])
+
+    def table_indices(self, names):
+        ''' Indices of the tables with the given names (names not in the lake and removed tables are ignored)
+        '''
+        names = set(names)
+        return np.array([idx for idx, name in enumerate(self.names) if name in names and not self.deleted[idx]],
+                        dtype=np.int64)
+
+    def add_tables(self, tables):
+        ''' Append (name, column vectors) pairs to the lake in place
+            The columns go to buffers whose capacity doubles when they are full, so adding tables one batch
+            at a time costs amortized time in the size of the batch. The first add copies the arrays into
+            memory, so a store opened from disk is detached from its files.
+        Return:
+            range of the indices of the new tables
+        '''
+        start = len(self)
+        if len(tables) == 0:
+            return range(start, start)
+        new = ColumnStore.from_tables(tables, dtype=self.vectors.dtype)
+        vectors = self.vectors
+        if self.num_columns == 0:
+            vectors = vectors.reshape(0, new.dim)
+        elif new.num_columns > 0 and new.dim != self.dim:
+            raise ValueError("Cannot add vectors of dimension %d to a lake of dimension %d" % (new.dim, self.dim))
+        size = self.num_columns
+        self._reserve(new.num_columns, vectors.shape[1])
+        bufferVectors, bufferNorms = self._buffers
+        bufferVectors[size:size + new.num_columns] = new.vectors.reshape(-1, vectors.shape[1])
+        bufferNorms[size:size + new.num_columns] = new.norms
+        self.vectors = bufferVectors[:size + new.num_columns]
+        self.norms = bufferNorms[:size + new.num_columns]
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + new.offsets[1:]])
+        self.names = np.concatenate([self.names, new.names])
+        self.deleted = np.concatenate([self.deleted, new.deleted])
+        self._changed()
+        return range(start, len(self))
+
+    def remove_tables(self, indices):
+        ''' Remove the tables at the given indices: they are marked in the `deleted` mask, in place, and keep
+            their rows until compact(), so the other tables keep their indices and nothing is copied
+        Return:
+            numpy array mapping every table index to its index after the removal (-1 for removed tables)
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        if not self.deleted[indices].all():
+            self.deleted[indices] = True
+            self._liveFingerprint = None
+        remap = np.arange(len(self), dtype=np.int64)
+        remap[self.deleted] = -1
+        return remap
+
+    def compact(self):
+        ''' Drop the rows of the removed tables from the arrays; the other tables keep their order
+        Return:
+            numpy array mapping every old table index to its new index (-1 for removed tables)
+        '''
+        kept = self.live_tables()
+        remap = np.full(len(self), -1, dtype=np.int64)
+        remap[kept] = np.arange(len(kept))
+        if len(kept) < len(self):
+            store = self.select(kept)
+            self.vectors, self.offsets, self.names, self.norms = store.vectors, store.offsets, store.names, store.norms
+            self.deleted = store.deleted
+            self._buffers = None
+            self._changed()
+        return remap
+
+    def _reserve(self, num_new, dim):
+        ''' Make room for num_new more columns, doubling the capacity of the buffers when they are full
+        '''
+        size = self.num_columns
+        needed = size + num_new
+        if self._buffers is not None and needed <= len(self._buffers[0]):
+            return
+        capacity = max(needed, 2 * size)
+        vectors = np.empty((capacity, dim), dtype=self.vectors.dtype)
+        norms = np.empty(capacity, dtype=self.norms.dtype)
+        vectors[:size] = self.vectors.reshape(size, dim)
+        norms[:size] = self.norms
+        self._buffers = (vectors, norms)
+
+    def _changed(self):
+        # the lake no longer matches the files it was opened from, nor its old fingerprint
+        self.path = None
+        self._fingerprint = None
+        self._liveFingerprint = None
+
+
+class SatoLake(object):
+    ''' A lake of 'sato' column vectors split once into its two parts.
+
+    `sherlock` is a ColumnStore over the Sherlock part of every column, re-normalized,
+    and `topics` holds the unit-norm topic vector of each table (taken from its first
+    column, zeros for empty tables), so the topic similarity of a query to all tables
+    is one mat-vec.
+    '''
+    def __init__(self, store):
+        '''
+        Args:
+            store (ColumnStore): the lake of full sato column vectors
+        '''
+        self.sherlock_dim = int(store.meta.get("sherlock_dim", SATO_SHERLOCK_DIM))
+        sherlock = np.array(store.vectors[:, :self.sherlock_dim])
+        norms = np.linalg.norm(sherlock, axis=1)
+        norms[norms == 0] = 1.0
+        sherlock /= norms[:, None]
+        # the mask is shared, so tables removed from the store later are removed here too
+        self.sherlock = ColumnStore(sherlock, store.offsets, store.names, meta=store.meta, deleted=store.deleted)
+        counts = store.column_counts()
+        self.topics = np.zeros((len(store), store.dim - self.sherlock_dim), dtype=store.vectors.dtype)
+        nonempty = np.flatnonzero(counts)
+        self.topics[nonempty] = store.vectors[store.offsets[nonempty], self.sherlock_dim:]
+        norms = np.linalg.norm(self.topics, axis=1)
+        norms[norms == 0] = 1.0
+        self.topics /= norms[:, None]
+
+    def split_query(self, vectors):
+        ''' The Sherlock part of the query columns and the topic vector of the query
+        '''
+        return vectors[:, :self.sherlock_dim], vectors[0, self.sherlock_dim:]
+
+    def score_map(self, vectors):
+        ''' Per-table scale and shift turning the matching score of the Sherlock parts into the sato score:
+            score = matching / min(# query columns, # table columns) + topic cosine similarity
+        Args:
+            vectors (numpy array): the query column vectors
+        Return:
+            (scale, shift) arrays with one entry per table
+        '''
+        querySherlock, querySato = self.split_query(vectors)
+        counts = np.maximum(self.sherlock.column_counts(), 1)
+        scale = 1 / np.minimum(len(querySherlock), counts)
+        queryNorm = np.linalg.norm(querySato)
+        shift = np.dot(self.topics, querySato / queryNorm) if queryNorm > 0 else np.zeros(len(self.topics))
+        return scale, shift
+
+    def block_score_maps(self, queries, start, stop):
+        ''' score_map of many queries at once, over the tables start:stop only
+        Args:
+            queries (list): the column vectors of each query
+            start, stop (int): the range of tables
+        Return:
+            (scale, shift) arrays of shape (# queries, stop - start)
+        '''
+        counts = np.maximum(self.sherlock.column_counts()[start:stop], 1)
+        lengths = np.array([len(self.split_query(vectors)[0]) for vectors in queries])
+        scale = 1 / np.minimum(lengths[:, None], counts[None, :])
+        querySato = np.array([self.split_query(vectors)[1] for vectors in queries])
+        queryNorms = np.linalg.norm(querySato, axis=1, keepdims=True)
+        # queries without a topic vector get no topic similarity, as in score_map
+        queryNorms[queryNorms == 0] = 1.0
+        shift = np.dot(querySato / queryNorms, self.topics[start:stop].T)
+        return scale, shift
+
+
+def reduce_segments(ufunc, values, offsets, axis=0, empty=0):
+    ''' Reduce consecutive segments of an array along an axis, e.g. per-table maxima over columns.
+    Unlike ufunc.reduceat, empty segments give `empty` instead of a neighbouring element.
+    Args:
+        ufunc: binary numpy ufunc (np.add, np.maximum, np.logical_or, ...)
+        values (numpy array): array to reduce
+        offsets (numpy array): segment i covers offsets[i]:offsets[i+1], offsets[-1] == values.shape[axis]
+        axis (int): the axis to reduce along
+        empty: value for empty segments
+    Return:
+        array with values.shape[axis] replaced by the number of segments
+    '''
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    shape = list(values.shape)
+    shape[axis] = len(counts)
+    out = np.full(shape, empty, dtype=values.dtype)
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty) > 0:
+        # the segment of a non-empty start runs up to the next non-empty start
+        index = [slice(None)] * values.ndim
+        index[axis] = nonempty
+        out[tuple(index)] = ufunc.reduceat(values, offsets[nonempty], axis=axis)
+    return out
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, "header.json"))
+
+
+def store_path(table_path):
+    ''' Path of the column store that goes with a pickled table list (x.pkl -> x.lake)
+    '''
+    return os.path.splitext(str(table_path))[0] + STORE_SUFFIX
+
+
+def _resolve_store(table_path):
+    ''' The store to read for table_path, or None if the pickle has to be used.
+    A store next to the pickle is only used if it is at least as new as the pickle.
+    '''
+    table_path = str(table_path)
+    if is_store(table_path):
+        return table_path
+    path = store_path(table_path)
+    if is_store(path):
+        if not os.path.exists(table_path) or \
+                os.path.getmtime(os.path.join(path, "header.json")) >= os.path.getmtime(table_path):
+            return path
+    return None
+
+
+def load_tables(table_path):
+    ''' Load a list of (table name, column vectors) pairs from a pickle or a column store
+    '''
+    path = _resolve_store(table_path)
+    if path is not None:
+        return ColumnStore.open(path).to_tables()
+    tfile = open(table_path,"rb")
+    tables = pickle.load(tfile)
+    tfile.close()
+    return tables
+
+
+def sample_tables(num_tables, scale, seed=None):
+    ''' Indices of the int(scale * num_tables) tables kept for a scalability experiment
+        With a seed, the sample is the sorted prefix of a seeded permutation: for a fixed seed,
+        the tables kept at a smaller scale are a subset of those kept at a larger one.
+        Without a seed, the tables are drawn with the random module.
+    '''
+    size = int(scale*num_tables)
+    if seed is None:
+        return random.sample(range(num_tables), size)
+    return np.sort(np.random.RandomState(seed).permutation(num_tables)[:size])
+
+
+def _sample_store(store, scale, seed=None):
+    # For scalability experiments: keep a percentage of tables
+    num_tables = len(store)
+    if int(scale*num_tables) < num_tables:
+        # only the sampled rows are read from disk, in file order
+        store = store.select(np.sort(sample_tables(num_tables, scale, seed)))
+    return store
+
+
+def load_lake(table_path, scale=1.0, seed=None):
+    ''' Load the data lake tables into a ColumnStore
+    Args:
+        table_path (str): pickle file holding a list of (table name, column vectors) pairs,
+            or a column store directory. A store saved next to the pickle is preferred.
+            An already loaded ColumnStore is used as is.
+        scale (float): for scalability experiments, the fraction of tables to keep
+        seed (int): seed of the table sample (see sample_tables); nested across scales
+    Return:
+        ColumnStore over a random sample of int(scale * # tables) tables
+    '''
+    if isinstance(table_path, ColumnStore):
+        return _sample_store(table_path, scale, seed)
+    path = _resolve_store(table_path)
+    if path is not None:
+        # memory-mapped: only the offsets, the names and the sampled vectors are read
+        full = ColumnStore.open(path)
+        store = _sample_store(full, scale, seed)
+        print("From %d total data-lake tables, scale down to %d tables" % (len(full), len(store)))
+        return store
+    # a pickle has to be read in full: convert it to a store (convert_embeddings.py) to sample cheaply
+    tables = load_tables(table_path)
+    # For scalability experiments: load a percentage of tables, in file order like _sample_store so the
+    # full lake (and its fingerprint) is the same on every run
+    sampled = tables
+    if int(scale*len(tables)) < len(tables):
+        sampled = [tables[idx] for idx in np.sort(sample_tables(len(tables), scale, seed))]
+    print("From %d total data-lake tables, scale down to %d tables" % (len(tables), len(sampled)))
+    return ColumnStore.from_tables(sampled)
@@ -1,75 +1,506 @@
 
+import functools
+import itertools
+import json
 import numpy as np
+import os
 import sys
-from tqdm import tqdm
-from iteration_utilities import duplicates, flatten, unique_everseen
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# On-disk layout of an LSH index directory (see CosineLSH.save)
+LSH_FORMAT = "starmie-lsh-index"
+LSH_VERSION = 2
+LSH_ARRAYS = ("base_vector", "base_offset", "bucket_keys", "bucket_offsets", "bucket_ids", "vectors", "signatures", "deleted")
+
+# number of set bits of every 16-bit value (numpy < 2.0 has no vectorized popcount)
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(1 << 16)], dtype=np.uint8)
+
+
+def hamming_distances(signatures, signature):
+    ''' Hamming distances between packed signatures
+    Args:
+        signatures (numpy array): (# signatures, # words) uint64 signatures
+        signature (numpy array): (# words,) uint64 signature
+    Return:
+        numpy array with the number of differing bits of every row of signatures
+    '''
+    diff = np.ascontiguousarray(signatures ^ signature)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(diff).sum(axis=1, dtype=np.int64)
+    return POPCOUNT_TABLE[diff.view(np.uint16)].sum(axis=1, dtype=np.int64)
+
+
+def _smallest(values, k):
+    ''' Positions of the k smallest values (all if k < 1), smallest first, ties by position
+    '''
+    if 0 < k < len(values):
+        kth = np.partition(values, k - 1)[k - 1]
+        below = np.flatnonzero(values < kth)
+        tied = np.flatnonzero(values == kth)[:k - len(below)]
+        top = np.concatenate([below, tied])
+    else:
+        top = np.arange(len(values))
+    return top[np.lexsort((top, values[top]))]
+
+
+# How the hyperplanes are chosen (see CosineLSH.fit): "random" Gaussian hyperplanes through the origin,
+# "orthogonal" random hyperplanes orthogonal within each table and "itq" hyperplanes learned by PCA and
+# iterative quantization; both fitted modes center the hyperplanes on the mean of a sample of the data.
+HASHING_MODES = ('random', 'orthogonal', 'itq')
+
+
+def _random_orthonormal(rows, cols):
+    # (rows, cols) matrix with orthonormal columns (cols <= rows)
+    q, r = np.linalg.qr(np.random.randn(rows, cols))
+    return q * np.sign(np.diag(r))
+
+
+def itq_rotation(projected, num_iter=50):
+    ''' Iterative quantization (Gong and Lazebnik): the rotation R that minimizes the quantization
+        error ||sign(V R) - V R|| of centered, projected data V
+    Args:
+        projected (numpy array): (# vectors, # bits) centered data in the subspace to binarize
+        num_iter (int): number of alternating updates of the codes and the rotation
+    Return:
+        (# bits, # bits) orthogonal rotation
+    '''
+    rotation = _random_orthonormal(projected.shape[1], projected.shape[1])
+    for _ in range(num_iter):
+        codes = np.where(projected.dot(rotation) >= 0, 1.0, -1.0)
+        # orthogonal Procrustes problem: the rotation of V closest to the codes
+        u, _, vt = np.linalg.svd(projected.T.dot(codes))
+        rotation = u.dot(vt)
+    return rotation
+
+
+def _save_array(path, array):
+    # write to a temporary file first and replace: indexes that memory-map the old file keep reading it
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp, path)
+
+
+def is_lsh_index(path):
+    return os.path.isfile(os.path.join(str(path), "header.json"))
+
+
+def read_lsh_header(path):
+    ''' Header of an index written by CosineLSH.save: its parameters and metadata
+    '''
+    with open(os.path.join(path, "header.json")) as f:
+        header = json.load(f)
+    if header.get("format") != LSH_FORMAT:
+        raise ValueError("%s is not an LSH index" % path)
+    if header.get("version") != LSH_VERSION:
+        raise ValueError("Unsupported LSH index version %s in %s (expected %d)"
+                         % (header.get("version"), path, LSH_VERSION))
+    return header
+
+
+@functools.lru_cache(maxsize=None)
+def _flip_masks(num_funcs, radius):
+    ''' All sets of at most radius of the num_funcs code bits, fewest bits first
+    Return:
+        (# sets,) int64 bit masks and (# sets, num_funcs) bool membership of the bits in each set
+    '''
+    sets = [flips for size in range(min(radius, num_funcs) + 1) for flips in itertools.combinations(range(num_funcs), size)]
+    members = np.zeros((len(sets), num_funcs), dtype=bool)
+    for idx, flips in enumerate(sets):
+        members[idx, list(flips)] = True
+    masks = members.dot(1 << np.arange(num_funcs, dtype=np.int64))
+    return masks, members
+
 
 class CosineLSH(object):
+    ''' Random hyperplane LSH for cosine similarity.
 
-    def __init__(self, num_funcs, dim, num_tables=100):
+    The hash tables are stored as one CSR structure over all tables: bucket_keys are
+    the sorted keys (hash table index * 2**num_funcs + hash code) of the non-empty
+    buckets, and bucket_ids[bucket_offsets[b]:bucket_offsets[b+1]] are the positions
+    of the vectors in bucket b, in insertion order. New entries are collected in a
+    pending list and merged into the CSR arrays before the next query.
+
+    Indexed vectors are kept in a buffer whose capacity doubles when it is full, so
+    inserting one vector at a time costs O(1) amortized copies. Next to each vector,
+    its signature (the sides of all num_tables * num_funcs hyperplanes) is kept packed
+    into uint64 words; the Hamming distance between two signatures estimates the angle
+    between the vectors, which queries can use to prefilter candidates.
+    '''
+
+    def __init__(self, num_funcs, dim, num_tables=100, base_vector=None, num_threads=1, base_offset=None, hashing='random'):
+        '''
+        Args:
+            num_funcs (int): number of hash functions (hyperplanes) per hash table
+            dim (int): dimension of the indexed vectors
+            num_tables (int): number of hash tables
+            base_vector (numpy array): (num_tables * num_funcs, dim) hyperplane normals (random if None)
+            num_threads (int): number of threads hashing a batch, each into its own share of the hash tables
+            base_offset (numpy array): (num_tables * num_funcs,) hyperplane offsets: hash bit i of x is
+                x . base_vector[i] > base_offset[i] (zeros if None)
+            hashing (str): how base_vector and base_offset were chosen, see HASHING_MODES
+        '''
         self.num_funcs = num_funcs
-        self.base_vectors = [np.random.randn(
-            num_funcs, dim) for i in range(num_tables)]
-        self.base_vector = np.vstack(self.base_vectors)
+        self.num_threads = num_threads
         self.num_tables = num_tables
-        self.hash_table = np.empty((2**num_funcs * num_tables,), object)
-        self.hash_table[...] = [[] for _ in range(2**num_funcs * num_tables)]
+        if base_vector is None:
+            base_vector = np.vstack([np.random.randn(
+                num_funcs, dim) for i in range(num_tables)])
+        if base_offset is None:
+            base_offset = np.zeros(num_tables * num_funcs)
+        self._set_hyperplanes(base_vector, base_offset, hashing)
+        self.bucket_keys = np.zeros(0, dtype=np.int64)
+        self.bucket_offsets = np.zeros(1, dtype=np.int64)
+        self.bucket_ids = np.zeros(0, dtype=np.int64)
+        # (keys, ids) pairs indexed since the last merge
+        self._pending = []
         self.dim = dim
-        self.vectors = None
+        self.num_words = -(-num_tables * num_funcs // 64)
+        # the first current_idx rows of the buffers are in use
+        self._vectors = None
+        self._signatures = np.zeros((0, self.num_words), dtype=np.uint64)
         self.current_idx = 0
         self.names = []
+        # removed vectors stay in the buckets but are never returned
+        self._deleted = np.zeros(0, dtype=bool)
+        # free-form metadata saved with the index (e.g. the fingerprint of the indexed lake)
+        self.meta = {}
 
-    def index_one(self, vector, name):
-        for hash_table_idx, base_vector in enumerate(self.base_vectors):
-            index = vector.dot(base_vector.T) > 0
-            index = (2**np.array(range(self.num_funcs)) * index).sum()
-            relative_index = hash_table_idx * 2 ** self.num_funcs + index
-            self.hash_table[relative_index].append(self.current_idx)
-        self.names.append(name)
-        if type(self.vectors) == type(None):
-            self.vectors = vector
+    def _set_hyperplanes(self, base_vector, base_offset, hashing):
+        self.base_vector = base_vector
+        self.base_vectors = [base_vector[i * self.num_funcs:(i + 1) * self.num_funcs] for i in range(self.num_tables)]
+        self.base_offset = base_offset
+        self.hashing = hashing
+
+    def fit(self, sample, hashing='itq', pca_dim=None, num_iter=50):
+        ''' Choose the hyperplanes from a sample of the vectors to index, before indexing any
+            Column embeddings are anisotropic: random hyperplanes through the origin mostly split the
+            data the same way, so many hash bits carry little information and buckets are skewed. Both
+            fitted modes put the hyperplanes through the sample mean. "orthogonal" draws the hyperplanes
+            of each table orthogonal to each other; "itq" takes a random num_funcs-dimensional subspace
+            of the top pca_dim principal components for each table, rotated by iterative quantization
+            so that its bits are balanced and uncorrelated.
+        Args:
+            sample (numpy array): (# vectors, dim) sample of the vectors to index
+            hashing (str): one of HASHING_MODES ("random" keeps the current hyperplanes)
+            pca_dim (int): number of principal components the "itq" subspaces are drawn from (4 * num_funcs if None)
+            num_iter (int): number of iterative quantization steps
+        '''
+        if hashing not in HASHING_MODES:
+            raise ValueError("Unknown hashing mode '%s', choose one of %s" % (hashing, HASHING_MODES))
+        if self.current_idx > 0:
+            raise ValueError("The hyperplanes can only be fitted before vectors are indexed")
+        if hashing == 'random':
+            return
+        if self.num_funcs > self.dim:
+            raise ValueError("Hashing mode '%s' needs num_funcs <= dim" % hashing)
+        sample = np.asarray(sample, dtype=np.float64)
+        mean = sample.mean(axis=0)
+        centered = sample - mean
+        if hashing == 'orthogonal':
+            planes = [_random_orthonormal(self.dim, self.num_funcs).T for _ in range(self.num_tables)]
+        else:
+            pca_dim = pca_dim or 4 * self.num_funcs
+            components = np.linalg.svd(centered, full_matrices=False)[2]
+            components = components[:max(min(pca_dim, len(components)), self.num_funcs)]
+            planes = []
+            for _ in range(self.num_tables):
+                basis = components.T.dot(_random_orthonormal(len(components), self.num_funcs))
+                planes.append(basis.dot(itq_rotation(centered.dot(basis), num_iter)).T)
+        base_vector = np.vstack(planes)
+        self._set_hyperplanes(base_vector, base_vector.dot(mean), hashing)
+
+    @classmethod
+    def load(cls, path, mmap=True, num_threads=1):
+        ''' Open an index written by CosineLSH.save
+        Args:
+            path (str): the index directory
+            mmap (bool): memory-map the arrays read-only instead of reading them into memory
+            num_threads (int): number of threads hashing new batches (see CosineLSH())
+        Return:
+            CosineLSH backed by the files in path; vectors indexed later are added in memory
+        '''
+        header = read_lsh_header(path)
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in LSH_ARRAYS}
+        index = cls(header["num_funcs"], header["dim"], header["num_tables"], base_vector=arrays["base_vector"],
+                    num_threads=num_threads, base_offset=arrays["base_offset"], hashing=header["hashing"])
+        index.bucket_keys = arrays["bucket_keys"]
+        index.bucket_offsets = arrays["bucket_offsets"]
+        index.bucket_ids = arrays["bucket_ids"]
+        index._vectors = arrays["vectors"]
+        index._signatures = arrays["signatures"]
+        # the only array changed in place, by remove()
+        index._deleted = np.array(arrays["deleted"])
+        index.current_idx = header["num_vectors"]
+        with open(os.path.join(path, "names.json")) as f:
+            index.names = json.load(f)
+        index.meta = header.get("meta", {})
+        return index
+
+    def save(self, path, **meta):
+        ''' Write the index to a directory that CosineLSH.load can memory-map
+        Args:
+            path (str): the index directory (created if missing)
+            meta: extra metadata recorded in the header (e.g. lake=<fingerprint of the indexed lake>)
+        '''
+        self._merge_pending()
+        os.makedirs(path, exist_ok=True)
+        if is_lsh_index(path):
+            # an index being overwritten stops being visible until it is complete again
+            os.remove(os.path.join(path, "header.json"))
+        self.meta = dict(self.meta, **meta)
+        vectors = self.vectors if self.vectors is not None else np.zeros((0, self.dim))
+        arrays = {
+            "base_vector": self.base_vector,
+            "base_offset": self.base_offset,
+            "bucket_keys": self.bucket_keys,
+            "bucket_offsets": self.bucket_offsets,
+            "bucket_ids": self.bucket_ids,
+            "vectors": vectors,
+            "signatures": self.signatures,
+            "deleted": self.deleted,
+        }
+        for name in LSH_ARRAYS:
+            _save_array(os.path.join(path, name + ".npy"), arrays[name])
+        with open(os.path.join(path, "names.json"), "w") as f:
+            json.dump([name.item() if isinstance(name, np.generic) else name for name in self.names], f)
+        header = {
+            "format": LSH_FORMAT,
+            "version": LSH_VERSION,
+            "num_funcs": int(self.num_funcs),
+            "dim": int(self.dim),
+            "num_tables": int(self.num_tables),
+            "hashing": self.hashing,
+            "num_vectors": int(self.current_idx),
+            "meta": self.meta,
+        }
+        # the header is written last so an index is only visible once complete
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump(header, f, indent=2)
+
+    @property
+    def vectors(self):
+        ''' (# indexed vectors, dim) indexed vectors, a view of the buffer
+        '''
+        if self._vectors is None:
+            return None
+        return self._vectors[:self.current_idx]
+
+    @property
+    def deleted(self):
+        return self._deleted[:self.current_idx]
+
+    @property
+    def signatures(self):
+        ''' (# indexed vectors, num_words) packed signatures of the indexed vectors
+        '''
+        return self._signatures[:self.current_idx]
+
+    def _reserve(self, num_new, dtype):
+        ''' Make room for num_new more vectors, doubling the capacity of the buffers when they are full
+        '''
+        needed = self.current_idx + num_new
+        if self._vectors is None:
+            dtype = np.result_type(dtype)
         else:
-            self.vectors = np.vstack([self.vectors, vector])
-    
+            dtype = np.result_type(self._vectors.dtype, dtype)
+            if needed <= len(self._vectors) and dtype == self._vectors.dtype:
+                return
+        capacity = max(needed, 2 * self.current_idx)
+        vectors = np.empty((capacity, self.dim), dtype=dtype)
+        deleted = np.zeros(capacity, dtype=bool)
+        signatures = np.zeros((capacity, self.num_words), dtype=np.uint64)
+        if self._vectors is not None:
+            vectors[:self.current_idx] = self.vectors
+            deleted[:self.current_idx] = self.deleted
+            signatures[:self.current_idx] = self.signatures
+        self._vectors, self._deleted, self._signatures = vectors, deleted, signatures
+
+    def _project(self, vectors):
+        # (# vectors, # tables * # funcs) projections on the hyperplane normals minus the offsets, their signs are the hash bits
+        return vectors.dot(self.base_vector.T) - self.base_offset
+
+    def _hash_codes(self, bits):
+        # (# vectors, # tables) hash codes: bit i of the code of table t is the side of hyperplane i of table t
+        codes = bits.reshape(-1, self.num_funcs).dot(2.0 ** np.arange(self.num_funcs)).astype(np.int64)
+        return codes.reshape(len(bits), -1)
+
+    def _pack_signatures(self, bits):
+        # (# vectors, num_words) signatures: hyperplane j is bit j % 64 of word j // 64
+        packed = np.packbits(bits, axis=1, bitorder='little')
+        words = np.zeros((len(bits), self.num_words * 8), dtype=np.uint8)
+        words[:, :packed.shape[1]] = packed
+        return words.view('<u8').astype(np.uint64)
+
+    def index_one(self, vector, name):
+        self.index_batch(np.reshape(vector, (1, -1)), [name])
+
+    def _hash_tables(self, vectors, idxs, bits, start, stop):
+        ''' Hash vectors into the tables start..stop-1
+            The sides of their hyperplanes are written to bits; returns the (keys, ids) entries sorted by key
+        '''
+        f = self.num_funcs
+        tableBits = vectors.dot(self.base_vector[start * f:stop * f].T) > self.base_offset[start * f:stop * f]
+        bits[:, start * f:stop * f] = tableBits
+        codes = self._hash_codes(tableBits).T
+        # sort every table's entries by code (a radix sort for small codes), so they are ordered by bucket key
+        order = np.argsort(codes.astype(np.uint16) if f <= 16 else codes, axis=1, kind='stable')
+        keys = np.take_along_axis(codes, order, axis=1) + (np.arange(start, stop, dtype=np.int64) * 2 ** f)[:, None]
+        return keys.ravel(), idxs[order].ravel()
+
     def index_batch(self, vectors, names):
-        idxs = range(self.current_idx, self.current_idx+ vectors.shape[0])
-        for hash_table_idx, base_vector in tqdm(enumerate(self.base_vectors), total = self.num_tables):
-            indices = vectors.dot(base_vector.T) > 0
-            indices = indices.dot(2 ** np.array(range(self.num_funcs)))
-            for index, idx in zip(indices, idxs):
-                relative_index = hash_table_idx * 2 ** self.num_funcs + index
-                self.hash_table[relative_index].append(idx)
+        idxs = np.arange(self.current_idx, self.current_idx + vectors.shape[0], dtype=np.int64)
+        bits = np.empty((vectors.shape[0], self.num_tables * self.num_funcs), dtype=bool)
+        # the hash tables are split into one contiguous share per thread; numpy releases the GIL in the
+        # projections and sorts. Shares are concatenated in table order, so the batch stays sorted by key.
+        bounds = np.linspace(0, self.num_tables, min(self.num_threads, self.num_tables) + 1).astype(int)
+        if len(bounds) > 2:
+            with ThreadPoolExecutor(len(bounds) - 1) as pool:
+                parts = list(pool.map(lambda share: self._hash_tables(vectors, idxs, bits, *share), zip(bounds[:-1], bounds[1:])))
+        else:
+            parts = [self._hash_tables(vectors, idxs, bits, 0, self.num_tables)]
+        self._pending.append((np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])))
+        self._reserve(vectors.shape[0], vectors.dtype)
+        self._vectors[self.current_idx:self.current_idx + vectors.shape[0]] = vectors
+        self._signatures[self.current_idx:self.current_idx + vectors.shape[0]] = self._pack_signatures(bits)
         self.current_idx += vectors.shape[0]
         self.names += names
-        if type(self.vectors) == type(None):
-                self.vectors = vectors
+
+    def _merge_pending(self):
+        ''' Merge the pending entries into the CSR arrays: each bucket keeps its old members
+            followed by the new ones, so members stay in insertion order
+        '''
+        if len(self._pending) == 0:
+            return
+        keys = np.concatenate([pending[0] for pending in self._pending])
+        ids = np.concatenate([pending[1] for pending in self._pending])
+        if len(self._pending) > 1:
+            # each batch is already sorted by key: merge the runs, keeping insertion order within buckets
+            order = np.argsort(keys, kind='stable')
+            keys, ids = keys[order], ids[order]
+        self._pending = []
+        newKeys, newCounts = np.unique(keys, return_counts=True)
+        allKeys = np.union1d(self.bucket_keys, newKeys)
+        oldCounts = np.zeros(len(allKeys), dtype=np.int64)
+        oldCounts[np.searchsorted(allKeys, self.bucket_keys)] = np.diff(self.bucket_offsets)
+        addCounts = np.zeros(len(allKeys), dtype=np.int64)
+        addCounts[np.searchsorted(allKeys, newKeys)] = newCounts
+        offsets = np.zeros(len(allKeys) + 1, dtype=np.int64)
+        np.cumsum(oldCounts + addCounts, out=offsets[1:])
+        merged = np.empty(offsets[-1], dtype=np.int64)
+        buckets = np.arange(len(allKeys))
+        oldRank = np.arange(len(self.bucket_ids)) - np.repeat(self.bucket_offsets[:-1], np.diff(self.bucket_offsets))
+        merged[np.repeat(offsets[:-1], oldCounts) + oldRank] = self.bucket_ids
+        addBucket = np.repeat(buckets, addCounts)
+        addRank = np.arange(len(ids)) - np.repeat(np.cumsum(addCounts) - addCounts, addCounts)
+        merged[offsets[addBucket] + oldCounts[addBucket] + addRank] = ids
+        self.bucket_keys, self.bucket_offsets, self.bucket_ids = allKeys, offsets, merged
+
+    def _bucket_members(self, keys):
+        ''' Members of the buckets with the given keys
+        Return:
+            the members of all buckets concatenated in the order of keys, and the number of members of each key
+        '''
+        self._merge_pending()
+        keys = np.asarray(keys).ravel()
+        pos = np.searchsorted(self.bucket_keys, keys)
+        hit = pos < len(self.bucket_keys)
+        hit[hit] = self.bucket_keys[pos[hit]] == keys[hit]
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[hit] = self.bucket_offsets[pos[hit] + 1] - self.bucket_offsets[pos[hit]]
+        starts = np.where(hit, self.bucket_offsets[np.minimum(pos, len(self.bucket_keys))], 0)
+        rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.bucket_ids[np.repeat(starts, counts) + rank], counts
+
+    def _probe_keys(self, projections, radius, num_probes=None):
+        ''' (# vectors, # probes) keys of the buckets probed for each vector in every table: the buckets whose
+            code differs from the vector's in at most radius bits, or with num_probes only the num_probes of
+            them most likely to hold its neighbors. Flipping a bit is less likely to lose neighbors the closer
+            the vector is to that bit's hyperplane, so bucket sets are ranked by the sum of the squared
+            distances to the hyperplanes of their flipped bits (the vector's own bucket always comes first).
+        '''
+        if radius < 0:
+            raise ValueError("Probing radius must be non-negative, got %s" % radius)
+        codes = self._hash_codes(projections > 0)
+        masks, members = _flip_masks(self.num_funcs, radius)
+        if num_probes is None or num_probes >= len(masks):
+            flips = np.broadcast_to(masks, codes.shape + masks.shape)
         else:
-            self.vectors = np.vstack([self.vectors, vectors])
-    
+            distances = (projections / np.linalg.norm(self.base_vector, axis=1)) ** 2
+            costs = distances.reshape(len(codes), self.num_tables, self.num_funcs).dot(members.T)
+            flips = masks[np.argsort(costs, axis=2, kind='stable')[:, :, :max(num_probes, 1)]]
+        tableKeys = (np.arange(self.num_tables, dtype=np.int64) * 2 ** self.num_funcs)[None, :, None]
+        return ((codes[:, :, None] ^ flips) + tableKeys).reshape(len(codes), -1)
+
+    def remove(self, idxs):
+        ''' Remove indexed vectors by position; positions of the remaining vectors do not change
+        '''
+        self.deleted[np.asarray(idxs, dtype=np.int64)] = True
+
     def get_size(self):
-        # Get the memory size of the vectors
-        vector_size = sys.getsizeof(self.vectors)
+        # Get the memory size of the vectors (the whole buffer, including unused capacity)
+        vector_size = sys.getsizeof(self._vectors)
         return (vector_size)/1000000
 
-       
-    def query(self, vector, N=10, radius=1):
-        res_indices = []
-        indices = vector.dot(self.base_vector.T).reshape(self.num_tables,-1) > 0
-        if radius == 0:
-            res_indices = indices.dot(2**np.arange(self.num_funcs)) + np.arange(self.num_tables) * 2**self.num_funcs
-        elif radius == 1:
-            clone_indices = indices.repeat(axis=0,repeats= self.num_funcs)
-            rel_indices = (np.arange(self.num_tables) * 2**self.num_funcs).repeat(axis=0,repeats=self.num_funcs)
-            translate = np.tile(np.eye(self.num_funcs), (self.num_tables,1))
-            res_indices = (np.abs(clone_indices-translate).dot(2**np.arange(self.num_funcs)) + rel_indices).astype(int)
-            res_indices = np.concatenate([res_indices, indices.dot(2**np.arange(self.num_funcs)) + np.arange(self.num_tables) * 2**self.num_funcs])
-    
-        lst = self.hash_table[res_indices].tolist()
-
-        res = list(unique_everseen(duplicates(flatten(lst))))
-        sim_scores = vector.dot(self.vectors[res].T)
-
-        max_sim_indices = sim_scores.argsort()[-N:][::-1]
-        max_sim_scores = sim_scores[max_sim_indices]
-
-        return [self.names[res[i]] for i in max_sim_indices],  [x for x in max_sim_scores]
\ No newline at end of file
+
+    def query(self, vector, N=10, radius=1, num_probes=None):
+        names, scores = self.query_many(np.reshape(vector, (1, -1)), N, radius, num_probes=num_probes)
+        return names[0], scores[0]
+
+    def query_many(self, vectors, N=10, radius=1, min_collisions=2, hamming_candidates=None, num_probes=None):
+        ''' Approximate nearest neighbors of a batch of vectors
+            Candidates are the indexed vectors sharing a probed bucket with the query in at least
+            min_collisions hash tables; they are reranked by their dot product with the query.
+            With hamming_candidates, only the candidates whose signatures are closest to the query's
+            signature in Hamming distance are reranked.
+        Args:
+            vectors (numpy array): (# queries, dim) query vectors
+            N (int): number of neighbors returned per query
+            radius (int): probe the buckets whose code differs from the query's in at most radius bits
+            min_collisions (int): number of tables in which a candidate must collide with the query
+            hamming_candidates (int): number of candidates reranked per query (all if None)
+            num_probes (int): number of buckets probed per table, the most likely ones within radius (all if None)
+        Return:
+            for each query, the names of its neighbors and their scores, best first (ties by insertion order)
+        '''
+        vectors = np.asarray(vectors)
+        numQueries = len(vectors)
+        projections = self._project(vectors)
+        bits = projections > 0
+        keys = self._probe_keys(projections, radius, num_probes)
+        members, counts = self._bucket_members(keys)
+        owners = np.repeat(np.repeat(np.arange(numQueries, dtype=np.int64), keys.shape[1]), counts)
+        # collision count of every (query, indexed vector) pair that collides at all. Dense counters are
+        # only used while they are no larger than the bucket hits, so memory never grows with the index size
+        codes = owners * self.current_idx + members
+        if numQueries * self.current_idx <= len(codes):
+            collisions = np.bincount(codes)
+            pairs = np.flatnonzero(collisions >= min_collisions)
+        else:
+            pairs, collisions = np.unique(codes, return_counts=True)
+            pairs = pairs[collisions >= min_collisions]
+        owners, cands = pairs // max(self.current_idx, 1), pairs % max(self.current_idx, 1)
+        alive = ~self.deleted[cands]
+        owners, cands = owners[alive], cands[alive]
+        # pairs are sorted by query, then by candidate
+        starts = np.searchsorted(owners, np.arange(numQueries + 1))
+        if hamming_candidates is not None:
+            querySignatures = self._pack_signatures(bits)
+            keep = [np.zeros(0, dtype=np.int64)]
+            for q in range(numQueries):
+                distances = hamming_distances(self.signatures[cands[starts[q]:starts[q + 1]]], querySignatures[q])
+                keep.append(starts[q] + np.sort(_smallest(distances, hamming_candidates)))
+            keep = np.concatenate(keep)
+            owners, cands = owners[keep], cands[keep]
+            starts = np.searchsorted(owners, np.arange(numQueries + 1))
+        # one product between all queries and all distinct candidates
+        uniqueCands, candIds = np.unique(cands, return_inverse=True)
+        sims = self.vectors[uniqueCands].dot(vectors.T)[candIds.reshape(-1), owners]
+        names, scores = [], []
+        for q in range(numQueries):
+            top = starts[q] + _smallest(-sims[starts[q]:starts[q + 1]], N)
+            names.append([self.names[idx] for idx in cands[top]])
+            scores.append(list(sims[top]))
+        return names, scores
@@ -1,102 +1,137 @@
 
 from locale import currency
 import numpy as np
-import random
-import pickle
 import os
 import time
 import sys
 
-from munkres import Munkres, make_cost_matrix, DISALLOWED
-from numpy.linalg import norm
-from lsh import CosineLSH
+from ann_search import ANNSearcher
+from lake import load_lake
+from assignment import DEFAULT_SOLVER
+from result_cache import ResultCache
+from lsh import CosineLSH, is_lsh_index, read_lsh_header
 
 
-class LSHSearcher(object):
+class LSHSearcher(ANNSearcher):
     def __init__(self,
                  table_path,
                  hash_func_num,
                  hash_table_num,
-                 scale
+                 scale,
+                 solver=DEFAULT_SOLVER,
+                 cache=None,
+                 seed=None,
+                 hamming_candidates=None,
+                 radius=1,
+                 num_probes=None,
+                 index_path=None,
+                 num_threads=1,
+                 hashing='random',
+                 fit_sample=10000
                  ):
-        tfile = open(table_path,"rb")
-        tables = pickle.load(tfile) # load a percentage of tables
-        self.tables = random.sample(tables, int(scale*len(tables)))
-        print("From %d total data-lake tables, scale down to %d tables" % (len(tables), len(self.tables)))
-        tfile.close()
+        # assignment backend used for exact verification (see assignment.SOLVERS)
+        self.solver = solver
+        # ResultCache serving repeated searches (None: always search)
+        self.cache = cache
+        # load tables to be queried: a ColumnStore of unit-norm float32 column vectors
+        # seed: reproducible, nested table samples for scale < 1 (see lake.sample_tables)
+        self.tables = load_lake(table_path, scale, seed)
+        # Sherlock/topic split of the lake, built on the first query with encoder 'sato'
+        self._satoLake = None
+        # number of index candidates per query column reranked by exact similarity, chosen by the Hamming
+        # distance of their LSH signatures (None: rerank all of them)
+        self.hamming_candidates = hamming_candidates
+        # buckets probed per hash table: those within radius bits of the query column's code, or only the
+        # num_probes most likely of them (see CosineLSH.query_many)
+        self.radius = radius
+        self.num_probes = num_probes
         print("hash_func_num: ", hash_func_num, "hash_table_num: ", hash_table_num)
         index_start_time = time.time()
-        self.vec_dim = len(self.tables[1][1][0])
+        self.vec_dim = self.tables.dim
         self.all_columns, self.col_table_ids = self._preprocess_table_lsh()
-        self.lsh = CosineLSH(hash_func_num, self.vec_dim, hash_table_num)
-        self.lsh.index_batch(self.all_columns, range(self.all_columns.shape[0]))
-        print("--- Indexing Time: %s seconds ---" % (time.time() - index_start_time))
+        # index_path: directory of a saved index (see CosineLSH.save). It is memory-mapped if it was built
+        # with the same parameters over the same lake, and rebuilt and saved otherwise.
+        # hashing: how the hyperplanes are chosen (see lsh.HASHING_MODES); the fitted modes learn them from
+        # fit_sample randomly drawn lake columns
+        if index_path is not None and self._index_matches(index_path, hash_func_num, hash_table_num, hashing, fit_sample):
+            self.lsh = CosineLSH.load(index_path, num_threads=num_threads)
+            print("--- Index Loading Time: %s seconds ---" % (time.time() - index_start_time))
+        else:
+            if index_path is not None and is_lsh_index(index_path):
+                print("--- Saved index %s was built with other parameters or another lake, rebuilding ---" % index_path)
+            # num_threads: threads building the index, each hashing the columns into a share of the tables
+            self.lsh = CosineLSH(hash_func_num, self.vec_dim, hash_table_num, num_threads=num_threads)
+            if hashing != 'random':
+                numColumns = self.all_columns.shape[0]
+                sample = np.sort(np.random.choice(numColumns, min(numColumns, fit_sample), replace=False))
+                self.lsh.fit(self.all_columns[sample], hashing)
+            self.lsh.index_batch(self.all_columns, range(self.all_columns.shape[0]))
+            if index_path is not None:
+                self.lsh.save(index_path, lake=self.tables.fingerprint(), fit_sample=fit_sample)
+            print("--- Indexing Time: %s seconds ---" % (time.time() - index_start_time))
         print("--- Size of LSH index %s MB ---" % (self.lsh.get_size()))
         # print("--- Size of LSH index %s MB (numpy nbytes) ---" % (self.lsh.nbytes)*1000000)
-    
-    def topk(self, enc, query, K, N=5, threshold=0.6):
-        # Note: N is the number of columns retrieved from the index
-        query_cols = []
-        for col in query[1]:
-            query_cols.append(col)
-        candidates = self._find_candidates(query_cols, N)
-        if enc == 'sato':
-            scores = []
-            querySherlock = query[1][:, :1187]
-            querySato = query[1][0, 1187:]
-            for table in candidates:
-                sherlock = table[1][:, :1187]
-                sato = table[1][0, 1187:]
-                sScore = self._verify(querySherlock, sherlock, threshold)
-                sherlockScore = (1/min(len(querySherlock), len(sherlock))) * sScore
-                satoScore = self._cosine_sim(querySato, sato)
-                score = sherlockScore + satoScore
-                scores.append((score, table[0]))
-        else: # encoder is sherlock
-            scores = [(self._verify(query[1], table[1], threshold), table[0]) for table in candidates]
-        scores.sort(reverse=True)
-        scoreLength = len(scores)
-        return scores[:K], scoreLength
-    
+
+    def _index_matches(self, index_path, hash_func_num, hash_table_num, hashing, fit_sample):
+        ''' Whether the index saved in index_path was built over this lake with these parameters
+        '''
+        if not is_lsh_index(index_path):
+            return False
+        try:
+            header = read_lsh_header(index_path)
+        except ValueError:
+            # written by another version: rebuilt and overwritten
+            return False
+        return header["num_funcs"] == hash_func_num and header["num_tables"] == hash_table_num and \
+            header["dim"] == self.vec_dim and header["meta"].get("lake") == self.tables.fingerprint() and \
+            header["hashing"] == hashing and (hashing == 'random' or header["meta"].get("fit_sample") == fit_sample)
+
     def _preprocess_table_lsh(self):
-        all_columns = []
-        col_table_ids = []
-        for idx,table in enumerate(self.tables):
-            for col in table[1]:
-                all_columns.append(col)
-                col_table_ids.append(idx)
-        all_columns = np.asarray(all_columns)
-        return all_columns, col_table_ids
+        # the store already holds every column contiguously, ordered by table
+        return self.tables.vectors, self.tables.column_table_ids()
     
     def _find_candidates(self,query_cols, N):
-        table_subs = set()
-        for col in query_cols:
-            result, _ = self.lsh.query(col, N)
-            for idx in result:
-                table_subs.add(self.col_table_ids[idx])
-        candidates = []
-        for tid in table_subs:
-            candidates.append(self.tables[tid])
-        return candidates
+        # all query columns are looked up in the index at once
+        results, _ = self.lsh.query_many(np.asarray(query_cols), N, self.radius,
+                                         hamming_candidates=self.hamming_candidates, num_probes=self.num_probes)
+        hits = [label for result in results for label in result]
+        return self._rank_tables(self.col_table_ids[np.asarray(hits, dtype=np.int64)])
     
-    def _cosine_sim(self, vec1, vec2):
-        assert vec1.ndim == vec2.ndim
-        return np.dot(vec1, vec2) / (norm(vec1)*norm(vec2))
+    def add_tables(self, tables):
+        ''' Add tables to the data lake and hash their columns into the LSH buckets
+        Args:
+            tables: list of (table name, column vectors) pairs
+        '''
+        tids = self.tables.add_tables(tables)
+        vectors = self.tables.vectors[self.tables.offsets[tids.start]:]
+        if len(vectors) > 0:
+            # labels are never reused: col_table_ids maps every label ever added to its table (-1 once removed)
+            labels = range(len(self.col_table_ids), len(self.col_table_ids) + len(vectors))
+            self.lsh.index_batch(vectors, labels)
+            self.col_table_ids = np.concatenate([self.col_table_ids, np.repeat(np.array(tids), self.tables.column_counts()[tids.start:])])
+        self.all_columns = self.tables.vectors
+        self._satoLake = None
 
-    def _verify(self, table1, table2, threshold):
-        score = 0.0
-        nrow = len(table1)
-        ncol = len(table2)
-        graph = np.zeros(shape=(nrow,ncol),dtype=float)
-        for i in range(nrow):
-            for j in range(ncol):
-                sim = self._cosine_sim(table1[i],table2[j])
-                if sim > threshold:
-                    graph[i,j] = sim
+    def remove_tables(self, names):
+        ''' Remove the tables with the given names from the data lake and the index
+        Return:
+            the number of tables removed
+        '''
+        indices = self.tables.table_indices(names)
+        if len(indices) == 0:
+            return 0
+        remap = self.tables.remove_tables(indices)
+        valid = self.col_table_ids >= 0
+        newIds = np.where(valid, remap[np.where(valid, self.col_table_ids, 0)], -1)
+        removedLabels = np.flatnonzero(valid & (newIds < 0))
+        self.lsh.remove(removedLabels)
+        self.col_table_ids = newIds
+        self.all_columns = self.tables.vectors
+        return len(indices)
 
-        max_graph = make_cost_matrix(graph, lambda cost: (graph.max() - cost) if (cost != DISALLOWED) else DISALLOWED)
-        m = Munkres()
-        indexes = m.compute(max_graph)
-        for row,col in indexes:
-            score += graph[row,col]
-        return score
\ No newline at end of file
+    def cache_scope(self):
+        ''' What results depend on besides the call arguments: the lake, the hyperplanes, the probing
+            and Hamming prefilter parameters and the solver
+        '''
+        return ResultCache.key(type(self).__name__, self.tables.fingerprint(), self.lsh.base_vector, self.lsh.base_offset,
+                               self.radius, self.num_probes, self.hamming_candidates, self.solver)
@@ -1,56 +1,273 @@
 import numpy as np
-import pickle
-import random
 import heapq
-from munkres import Munkres, make_cost_matrix, DISALLOWED
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
 from numpy.linalg import norm
-from bounds import verify, upper_bound_bm, lower_bound_bm, get_edges
+from bounds import verify, verify_tables, get_edges, similarity_graph, matching_bounds, normalize_rows, lake_upper_bounds, lake_table_scores, BOUND_TOLERANCE, VERIFY_CHUNK
+from lake import ColumnStore, SatoLake, load_lake, reduce_segments, STORE_SUFFIX
+from assignment import DEFAULT_SOLVER, batch_max_weight_matching
+from result_cache import ResultCache, cached_search, search_key
+from search_result import SearchResult
+
+# Number of lake columns bounded at once by a time-budgeted search: the budget is checked between blocks,
+# so a small budget costs about one block whatever the size of the lake
+ANYTIME_BLOCK_SIZE = 1 << 14
+
+# State of a search worker process, set once by _init_worker
+_worker_store = None
+_worker_solver = None
+# searchers over the worker's shards, kept across queries so their precomputed state is reused
+_worker_searchers = {}
+
+
+def _init_worker(store_path, solver):
+    ''' Pool initializer: memory-map the shared column store once per worker process
+    '''
+    global _worker_store, _worker_solver
+    _worker_store = ColumnStore.open(store_path)
+    _worker_solver = solver
+
+
+def _search_shard(task):
+    ''' Run a serial search method over the tables start:stop of the worker's store
+    Return:
+        the local top-K of that shard
+    '''
+    method, start, stop, deleted, enc, query, K, threshold = task
+    # the tables removed since the pool started: the shard searchers see the mask through their slices
+    _worker_store.deleted[start:stop] = deleted
+    if (start, stop) not in _worker_searchers:
+        _worker_searchers[start, stop] = NaiveSearcher(_worker_store.slice(start, stop), 1.0, solver=_worker_solver)
+    searcher = _worker_searchers[start, stop]
+    return getattr(searcher, method)(enc, query, K, threshold)
+
 
 class NaiveSearcher(object):
     def __init__(self,
                  table_path,
                  scale,
-                 index_path=None
+                 index_path=None,
+                 solver=DEFAULT_SOLVER,
+                 num_workers=1,
+                 cache=None,
+                 seed=None
                  ):
         if index_path != None:
             self.index_path = index_path
+        # assignment backend used for exact verification (see assignment.SOLVERS)
+        self.solver = solver
+        # with num_workers > 1, topk and topk_bounds split the lake across a process pool
+        self.num_workers = num_workers
+        self._pool = None
+        self._tmpdir = None
+        # Sherlock/topic split of the lake, built on the first query with encoder 'sato'
+        self._satoLake = None
+        # ResultCache serving repeated searches (None: always search)
+        self.cache = cache
 
-        # load tables to be queried
-        tfile = open(table_path,"rb")
-        tables = pickle.load(tfile)
-        # For scalability experiments: load a percentage of tables
-        self.tables = random.sample(tables, int(scale*len(tables)))
-        print("From %d total data-lake tables, scale down to %d tables" % (len(tables), len(self.tables)))
-        tfile.close()
+        # load tables to be queried: a ColumnStore of unit-norm float32 column vectors
+        # seed: reproducible, nested table samples for scale < 1 (see lake.sample_tables)
+        self.tables = load_lake(table_path, scale, seed)
 
-    def topk(self, enc, query, K, threshold=0.6):
+    @cached_search
+    def topk(self, enc, query, K, threshold=0.6, time_budget=None):
         ''' Exact top-k cosine similarity with full bipartite matching
         Args:
             enc (str): choice of encoder (e.g. 'sato', 'cl', 'sherlock') -- mainly to check if the encoder is 'sato'
             query: the query, where query[0] is the query filename, and query[1] is the set of column vectors
             K (int): choice of K
             threshold (float): similarity threshold. For small SANTOS benchmark, we use threshold=0.7. For the larger benchmarks, threshold=0.1
+            time_budget (float): if set, search time in seconds: tables are verified by decreasing upper bound
+                (see topk_ordered) until the result is exact or the budget runs out
         Return:
-            Tables with top-K scores
+            Tables with top-K scores (a SearchResult with an `exact` flag if time_budget is set)
         '''
-        if enc == 'sato':
-            # For SATO encoder, the first 1187 items in the vector are from Sherlock. The rest are from topic modeling
-            scores = []
-            querySherlock = query[1][:, :1187]
-            querySato = query[1][0, 1187:]
-            for table in self.tables:
-                sherlock = table[1][:, :1187]
-                sato = table[1][0, 1187:]
-                sScore = self._verify(querySherlock, sherlock, threshold)
-                sherlockScore = (1/min(len(querySherlock), len(sherlock))) * sScore
-                satoScore = self._cosine_sim(querySato, sato)
-                score = sherlockScore + satoScore
-                scores.append((score, table[0]))
-        else:
-            scores = [(self._verify(query[1], table[1], threshold), table[0]) for table in self.tables]
+        if time_budget is not None:
+            return self.topk_ordered(enc, query, K, threshold, time_budget=time_budget)
+        if self.num_workers > 1:
+            return self._topk_parallel('topk', enc, query, K, threshold)
+        store, queryCols, scale, shift = self._search_space(enc, query)
+        tids = store.live_tables()
+        tScores = verify_tables(queryCols, store, tids, threshold, solver=self.solver, normalized=True)
+        scores = list(zip(scale[tids] * tScores + shift[tids], store.names[tids]))
         scores.sort(reverse=True)
         return scores[:K]
 
+    def topk_batch(self, enc, queries, K, threshold=0.6, block_size=1 << 22):
+        ''' Exact top-k for a batch of queries, same results as calling topk() on each query
+            The lake is scanned once for the whole batch: the similarities of all query columns
+            against a block of lake columns come from one matrix multiply, and the assignment
+            solver only runs for (query, table) pairs that have at least one edge, grouped by
+            column counts like verify_tables.
+        Args:
+            enc (str): choice of encoder (e.g. 'sato', 'cl', 'sherlock') -- mainly to check if the encoder is 'sato'
+            queries: list of queries, where query[0] is the query filename, and query[1] is the set of column vectors
+            K (int): choice of K
+            threshold (float): similarity threshold
+            block_size (int): number of (query column, lake column) similarities computed at once
+        Return:
+            list with the tables with top-K scores of each query
+        '''
+        if self.cache is None:
+            return self._topk_batch(enc, queries, K, threshold, block_size)
+        # results are shared with topk(): only the queries missing from the cache are searched
+        keys = [search_key(self, 'topk', query, enc=enc, K=K, threshold=threshold, time_budget=None) for query in queries]
+        results = [self.cache.get(key) for key in keys]
+        missing = [qi for qi, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            found = self._topk_batch(enc, [queries[qi] for qi in missing], K, threshold, block_size)
+            for qi, result in zip(missing, found):
+                self.cache.put(keys[qi], result)
+                results[qi] = result
+        return results
+
+    def _topk_batch(self, enc, queries, K, threshold, block_size):
+        if len(queries) == 0:
+            return []
+        if enc == 'sato':
+            satoLake = self._sato_lake()
+            store = satoLake.sherlock
+            queryCols = [normalize_rows(satoLake.split_query(query[1])[0]) for query in queries]
+        else:
+            store = self.tables
+            queryCols = [normalize_rows(query[1]) for query in queries]
+        qCounts = np.array([len(q) for q in queryCols], dtype=np.int64)
+        qOffsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        np.cumsum(qCounts, out=qOffsets[1:])
+        allQueryCols = np.concatenate(queryCols, axis=0)
+        # running top-K of every query, merged with the scores of each block: memory does not grow with the lake
+        topScores = np.zeros((len(queries), 0))
+        topIds = np.zeros((len(queries), 0), dtype=np.int64)
+        # ties are broken by table name, as when topk() sorts its (score, name) pairs
+        nameRanks = np.argsort(np.argsort(store.names, kind='stable'), kind='stable')
+        offsets = store.offsets
+        # the similarity block holds every query column of the batch: size it by their number
+        blockColumns = max(1, block_size // max(len(allQueryCols), 1))
+        for start, stop in store.blocks(blockColumns):
+            sims = np.dot(allQueryCols, store.vectors[offsets[start]:offsets[stop]].T)
+            sims[sims <= threshold] = 0.0
+            tOffsets = offsets[start:stop + 1] - offsets[start]
+            tCounts = np.diff(tOffsets)
+            if threshold >= 0:
+                # (query, table) pairs with an edge; all the others score 0 without calling the solver
+                hasEdge = reduce_segments(np.logical_or, sims > 0, tOffsets, axis=1)
+                hasEdge = reduce_segments(np.logical_or, hasEdge, qOffsets, axis=0)
+            else:
+                # negative similarities are edges too: every pair is matched, as in topk()
+                hasEdge = np.ones((len(queries), stop - start), dtype=bool)
+            hasEdge &= (qCounts > 0)[:, None] & (tCounts > 0)[None, :]
+            blockScores = np.zeros((len(queries), stop - start))
+            qIds, tIds = np.nonzero(hasEdge)
+            # pairs with the same (query, table) column counts are solved together
+            shapes = np.stack([qCounts[qIds], tCounts[tIds]], axis=1)
+            uniqueShapes, shapeIds = np.unique(shapes, axis=0, return_inverse=True)
+            shapeIds = shapeIds.reshape(-1)
+            for si, (m, n) in enumerate(uniqueShapes):
+                members = np.flatnonzero(shapeIds == si)
+                rows = qOffsets[qIds[members]][:, None] + np.arange(m)
+                cols = tOffsets[tIds[members]][:, None] + np.arange(n)
+                graphs = sims[rows[:, :, None], cols[:, None, :]]
+                blockScores[qIds[members], tIds[members]] = batch_max_weight_matching(graphs, self.solver)
+            if enc == 'sato':
+                scale, shift = satoLake.block_score_maps([query[1] for query in queries], start, stop)
+                blockScores = scale * blockScores + shift
+            live = np.flatnonzero(~store.deleted[start:stop])
+            scores = np.concatenate([topScores, blockScores[:, live]], axis=1)
+            ids = np.concatenate([topIds, np.broadcast_to(start + live, (len(queries), len(live)))], axis=1)
+            best = np.lexsort((-nameRanks[ids], -scores), axis=1)[:, :K]
+            topScores = np.take_along_axis(scores, best, axis=1)
+            topIds = np.take_along_axis(ids, best, axis=1)
+        return [list(zip(topScores[qi], store.names[topIds[qi]])) for qi in range(len(queries))]
+
+    @cached_search
+    def topk_ordered(self, enc, query, K, threshold=0.6, time_budget=None):
+        ''' Algorithm: Bound-ordered early termination
+            Same results as topk(): tables are verified in decreasing order of their upper bound
+            (lake_upper_bounds), and the search stops as soon as the next bound is below the
+            current K-th exact score, since no table left can enter the top-K.
+            With a time budget this is an anytime search (see _topk_anytime): when the budget runs
+            out, the best tables verified so far are returned.
+        Args:
+            enc (str): choice of encoder (e.g. 'sato', 'cl', 'sherlock') -- mainly to check if the encoder is 'sato'
+            query: the query, where query[0] is the query filename, and query[1] is the set of column vectors
+            K (int): choice of K
+            threshold (float): similarity threshold
+            time_budget (float): search time in seconds (no limit if None; runs in this process)
+        Return:
+            Tables with top-K scores (a SearchResult with an `exact` flag if time_budget is set)
+        '''
+        deadline = None if time_budget is None else time.time() + time_budget
+        if self.num_workers > 1 and deadline is None:
+            return self._topk_parallel('topk_ordered', enc, query, K, threshold)
+        store, queryCols, scale, shift = self._search_space(enc, query)
+        if deadline is not None:
+            return self._topk_anytime(store, queryCols, scale, shift, K, threshold, deadline)
+        matchBounds = lake_upper_bounds(queryCols, store, threshold)
+        upperBounds = scale * matchBounds + shift
+        H = []
+        tids = store.live_tables()
+        for idx in tids[np.argsort(-upperBounds[tids], kind='stable')]:
+            if len(H) == K and upperBounds[idx] + BOUND_TOLERANCE < H[0][0]:
+                break
+            if matchBounds[idx] == 0 and threshold >= 0:
+                # no edge above the threshold
+                score = 0.0
+            else:
+                score = self._verify(queryCols, store.table(idx), threshold, normalized=True)
+            item = (scale[idx] * score + shift[idx], store.names[idx])
+            if len(H) < K:
+                heapq.heappush(H, item)
+            elif item > H[0]:
+                heapq.heapreplace(H, item)
+        H.sort(reverse=True)
+        return H
+
+    def _topk_anytime(self, store, queryCols, scale, shift, K, threshold, deadline):
+        ''' Time-budgeted topk_ordered: the lake is bounded one block of ANYTIME_BLOCK_SIZE columns at a
+            time, and the tables of each block are verified in decreasing order of their upper bound,
+            VERIFY_CHUNK at a time, skipping those that cannot beat the current K-th score. The deadline
+            is checked between blocks and chunks, after at least one chunk has been verified. If every
+            block is done before the deadline, the result is the exact top-K.
+        Return:
+            SearchResult with the best tables verified and its `exact` flag
+        '''
+        H = []
+        exact = True
+        for start, stop in store.blocks(ANYTIME_BLOCK_SIZE):
+            if H and time.time() > deadline:
+                exact = False
+                break
+            blockBounds = lake_upper_bounds(queryCols, store.slice(start, stop), threshold)
+            upperBounds = scale[start:stop] * blockBounds + shift[start:stop]
+            order = np.argsort(-upperBounds, kind='stable')
+            order = order[~store.deleted[start + order]]
+            for chunkStart in range(0, len(order), VERIFY_CHUNK):
+                chunk = order[chunkStart:chunkStart + VERIFY_CHUNK]
+                if len(H) == K:
+                    chunk = chunk[upperBounds[chunk] + BOUND_TOLERANCE >= H[0][0]]
+                    if len(chunk) == 0:
+                        # bounds are decreasing: no table left in this block can enter the top-K
+                        break
+                if H and time.time() > deadline:
+                    exact = False
+                    break
+                tids = start + chunk
+                scores = scale[tids] * verify_tables(queryCols, store, tids, threshold, solver=self.solver, normalized=True) + shift[tids]
+                for score, tid in zip(scores, tids):
+                    item = (score, store.names[tid])
+                    if len(H) < K:
+                        heapq.heappush(H, item)
+                    elif item > H[0]:
+                        heapq.heapreplace(H, item)
+            if not exact:
+                break
+        H.sort(reverse=True)
+        return SearchResult(H, exact)
+
+    @cached_search
     def topk_bounds(self, enc, query, K, threshold=0.6):
         ''' Algorithm: Pruning with Bounds
             Bounds Techique: reduce # of verification calls
@@ -62,49 +279,40 @@ class NaiveSearcher(object):
         Return:
             Tables with top-K scores
         '''
+        if self.num_workers > 1:
+            return self._topk_parallel('topk_bounds', enc, query, K, threshold)
         H = []
         heapq.heapify(H)
-        if enc == 'sato':
-            querySherlock = query[1][:, :1187]
-            querySato = query[1][0, 1187:]
-        satoScore = 0.0
-        for table in self.tables:
-            # get sherlock and sato components if the encoder is 'sato
-            if enc == 'sato':
-                tScore = table[1][:, :1187]
-                qScore = querySherlock
-                sato = table[1][0, 1187:]
-                satoScore = self._cosine_sim(querySato, sato)
-            else:
-                tScore = table[1]
-                qScore = query[1]
+        store, queryCols, scale, shift = self._search_space(enc, query)
+        # Prefilter: upper bounds of all tables from one pass over the lake column matrix
+        upperBounds = scale * lake_upper_bounds(queryCols, store, threshold) + shift
+        for idx in store.live_tables():
+            tCols = store.table(idx)
+            name = store.names[idx]
 
             # add to heap to get len(H) = K
             if len(H) < K: # len(H) = number of elements in H
-                score = verify(qScore, tScore, threshold)
-                if enc == 'sato': score = self._combine_sherlock_sato(score, qScore, tScore, satoScore)
-                heapq.heappush(H, (score, table[0]))
+                score = scale[idx] * self._verify(queryCols, tCols, threshold, normalized=True) + shift[idx]
+                heapq.heappush(H, (score, name))
             else:
                 topScore = H[0]
-                # Helper method from bounds.py for to reduce the cost of the graph
-                edges, nodes1, nodes2 = get_edges(qScore, tScore, threshold)
-                lb = lower_bound_bm(edges, nodes1, nodes2)
-                ub = upper_bound_bm(edges, nodes1, nodes2)
-                if enc == 'sato':
-                    lb = self._combine_sherlock_sato(lb, qScore, tScore, satoScore)
-                    ub = self._combine_sherlock_sato(ub, qScore, tScore, satoScore)
+                if upperBounds[idx] + BOUND_TOLERANCE < topScore[0]:
+                    # can not beat the current K-th score: skip the per-table bounds and verification
+                    continue
+                # Helper method from bounds.py: both bounds from one sorted edge array of the graph
+                lb, ub = matching_bounds(similarity_graph(queryCols, tCols, threshold, normalized=True))
+                lb = scale[idx] * lb + shift[idx]
+                ub = scale[idx] * ub + shift[idx]
 
                 if lb > topScore[0]:
                     heapq.heappop(H)
-                    score = verify(qScore, tScore, threshold)
-                    if enc == 'sato': score = self._combine_sherlock_sato(score, qScore, tScore, satoScore)
-                    heapq.heappush(H, (score, table[0]))
+                    score = scale[idx] * self._verify(queryCols, tCols, threshold, normalized=True) + shift[idx]
+                    heapq.heappush(H, (score, name))
                 elif ub >= topScore[0]:
-                    score = verify(qScore, tScore, threshold)
-                    if enc == 'sato': score = self._combine_sherlock_sato(score, qScore, tScore, satoScore)
+                    score = scale[idx] * self._verify(queryCols, tCols, threshold, normalized=True) + shift[idx]
                     if score > topScore[0]:
                         heapq.heappop(H)
-                        heapq.heappush(H, (score, table[0]))
+                        heapq.heappush(H, (score, name))
         scores = []
         while len(H) > 0:
             scores.append(heapq.heappop(H))
@@ -112,13 +320,132 @@ class NaiveSearcher(object):
         return scores
         
 
-    def _combine_sherlock_sato(self, score, qScore, tScore, satoScore):
-        ''' Helper method for topk_bounds() to calculate sherlock and sato scores, if the encoder is SATO
+    @cached_search
+    def topk_rerank(self, enc, query, K, threshold=0.6, rerank_budget=100, scorer='bound'):
+        ''' Two-stage search: a cheap vectorized score (bounds.lake_table_scores) ranks the whole lake,
+            then only the best rerank_budget tables are verified with exact matching.
+            A larger budget trades latency for recall; with the 'bound' scorer the result is the
+            same as topk() once the K-th exact score is above the bound of every table left out.
+        Args:
+            enc (str): choice of encoder (e.g. 'sato', 'cl', 'sherlock') -- mainly to check if the encoder is 'sato'
+            query: the query, where query[0] is the query filename, and query[1] is the set of column vectors
+            K (int): choice of K
+            threshold (float): similarity threshold
+            rerank_budget (int): number of tables verified exactly (at least K)
+            scorer (str): the cheap table score, 'bound' or 'colmax' (see bounds.LAKE_SCORERS)
+        Return:
+            Tables with top-K scores
+        '''
+        store, queryCols, scale, shift = self._search_space(enc, query)
+        cheapScores = scale * lake_table_scores(queryCols, store, threshold, scorer) + shift
+        tids = store.live_tables()
+        candidates = np.sort(tids[np.argsort(-cheapScores[tids], kind='stable')[:max(rerank_budget, K)]])
+        tScores = verify_tables(queryCols, store, candidates, threshold, solver=self.solver, normalized=True)
+        scores = list(zip(scale[candidates] * tScores + shift[candidates], store.names[candidates]))
+        scores.sort(reverse=True)
+        return scores[:K]
+
+    def _topk_parallel(self, method, enc, query, K, threshold):
+        ''' Run a serial search method on every shard of the lake in the process pool and merge
+            the local top-K lists; any table in the global top-K is in the top-K of its shard
+        '''
+        if self._pool is None:
+            self._start_pool()
+        deleted = self.tables.deleted
+        tasks = [(method, start, stop, deleted[start:stop], enc, query, K, threshold) for start, stop in self._shards]
+        scores = []
+        for shard_scores in self._pool.map(_search_shard, tasks):
+            scores.extend(shard_scores)
+        scores.sort(reverse=True)
+        return scores[:K]
+
+    def _start_pool(self):
+        ''' Start the worker pool. Workers memory-map the lake from a column store on disk
+            instead of receiving a pickled copy; a lake that is not backed by a store yet
+            (loaded from a pickle or scaled down) is written to a temporary one first.
+        '''
+        path = self.tables.path
+        if path is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="starmie_lake_")
+            path = os.path.join(self._tmpdir, "lake" + STORE_SUFFIX)
+            self.tables.save(path)
+        # a few shards per worker of about the same number of columns, for load balancing
+        num_shards = max(1, min(len(self.tables), 4 * self.num_workers))
+        block_size = -(-self.tables.num_columns // num_shards)
+        self._shards = list(self.tables.blocks(max(block_size, 1)))
+        ctx = multiprocessing.get_context("spawn")
+        self._pool = ctx.Pool(self.num_workers, initializer=_init_worker, initargs=(path, self.solver))
+
+    def close(self):
+        ''' Stop the worker pool (if any) and remove its temporary column store
+        '''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def add_tables(self, tables):
+        ''' Add tables to the data lake without reloading it
+        Args:
+            tables: list of (table name, column vectors) pairs
+        '''
+        self.tables.add_tables(tables)
+        self._lake_changed()
+
+    def remove_tables(self, names):
+        ''' Remove the tables with the given names from the data lake
+        Return:
+            the number of tables removed
+        '''
+        indices = self.tables.table_indices(names)
+        if len(indices) == 0:
+            return 0
+        # the tables are only marked removed: the Sato split shares the mask and the pool's workers get it
+        # with every task, so neither is rebuilt
+        self.tables.remove_tables(indices)
+        return len(indices)
+
+    def compact(self):
+        ''' Drop the removed tables from the lake's arrays (see ColumnStore.compact), e.g. after many removals
+        '''
+        if self.tables.deleted.any():
+            self.tables.compact()
+            self._lake_changed()
+
+    def _lake_changed(self):
+        # the Sato split is rebuilt on demand, and the pool's workers map the old lake
+        self._satoLake = None
+        self.close()
+
+    def cache_scope(self):
+        ''' What results depend on besides the call arguments: the lake and the assignment solver
+        '''
+        return ResultCache.key(type(self).__name__, self.tables.fingerprint(), self.solver)
+
+    def _sato_lake(self):
+        ''' The lake split into its Sherlock and topic parts (see lake.SatoLake), built once
         '''
-        sherlockScore = (1/min(len(qScore), len(tScore))) * score
-        full_satoScore = sherlockScore + satoScore
-        return full_satoScore
+        if self._satoLake is None:
+            self._satoLake = SatoLake(self.tables)
+        return self._satoLake
 
+    def _search_space(self, enc, query):
+        ''' What the query is matched against for the given encoder
+            For 'sato', the Sherlock part of the query is matched against the Sherlock part of the lake,
+            and the final score of a table adds the topic similarity (see SatoLake.score_map).
+        Return:
+            (store, normalized query columns, scale, shift): the score of table i is scale[i] * matching + shift[i]
+        '''
+        if enc == 'sato':
+            satoLake = self._sato_lake()
+            scale, shift = satoLake.score_map(query[1])
+            return satoLake.sherlock, normalize_rows(satoLake.split_query(query[1])[0]), scale, shift
+        return self.tables, normalize_rows(query[1]), np.ones(len(self.tables)), np.zeros(len(self.tables))
+
+    @cached_search
     def topk_greedy(self, enc, query, K, threshold=0.6):
         ''' Greedy algorithm for matching
         Args:
@@ -129,20 +456,9 @@ class NaiveSearcher(object):
         Return:
             Tables with top-K scores
         '''
-        if enc == 'sato':
-            scores = []
-            querySherlock = query[1][:, :1187]
-            querySato = query[1][0, 1187:]
-            for table in self.tables:
-                sherlock = table[1][:, :1187]
-                sato = table[1][0, 1187:]
-                sScore = self._verify_greedy(querySherlock, sherlock, threshold)
-                sherlockScore = (1/min(len(querySherlock), len(sherlock))) * sScore
-                satoScore = self._cosine_sim(querySato, sato)
-                score = sherlockScore + satoScore
-                scores.append((score, table[0]))
-        else: # encoder is sherlock
-            scores = [(self._verify_greedy(query[1], table[1], threshold), table[0]) for table in self.tables]
+        store, queryCols, scale, shift = self._search_space(enc, query)
+        scores = [(scale[idx] * self._verify_greedy(queryCols, store.table(idx), threshold) + shift[idx], store.names[idx])
+                  for idx in store.live_tables()]
         scores.sort(reverse=True)
         return scores[:K]
 
@@ -152,39 +468,12 @@ class NaiveSearcher(object):
         assert vec1.ndim == vec2.ndim
         return np.dot(vec1, vec2) / (norm(vec1)*norm(vec2))
 
-    def _verify(self, table1, table2, threshold):
-        score = 0.0
-        nrow = len(table1)
-        ncol = len(table2)
-        graph = np.zeros(shape=(nrow,ncol),dtype=float)
-        for i in range(nrow):
-            for j in range(ncol):
-                sim = self._cosine_sim(table1[i],table2[j])
-                if sim > threshold:
-                    graph[i,j] = sim
-
-        max_graph = make_cost_matrix(graph, lambda cost: (graph.max() - cost) if (cost != DISALLOWED) else DISALLOWED)
-        m = Munkres()
-        indexes = m.compute(max_graph)
-        for row,col in indexes:
-            score += graph[row,col]
-        return score
+    def _verify(self, table1, table2, threshold, normalized=False):
+        return verify(table1, table2, threshold, normalized, solver=self.solver)
 
     def _verify_greedy(self, table1, table2, threshold):
-        nodes1 = set()
-        nodes2 = set()
+        edges, nodes1, nodes2 = get_edges(table1, table2, threshold)
         score = 0.0
-        nrow = len(table1)
-        ncol = len(table2)
-        edges = []
-        for i in range(nrow):
-            for j in range(ncol):
-                sim = self._cosine_sim(table1[i],table2[j])
-                if sim > threshold:
-                    edges.append((sim,i,j))
-                    nodes1.add(i)
-                    nodes2.add(j)
-        edges.sort(reverse=True)
         for e in edges:
             score += e[0]
             nodes1.discard(e[1])
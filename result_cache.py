@@ -0,0 +1,121 @@
+import copy
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from lake import array_fingerprint
+
+
+class ResultCache(object):
+    ''' Cache of search results, keyed by a hash of everything a result depends on.
+
+    Entries live in memory with least-recently-used eviction. With a cache directory,
+    every entry is also written there as one pickle per key, so later runs (other
+    scripts, other processes) are served from disk without searching again.
+    '''
+    def __init__(self, max_entries=10000, cache_dir=None):
+        '''
+        Args:
+            max_entries (int): number of results kept in memory
+            cache_dir (str): directory of the on-disk backing store (memory only if None)
+        '''
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        ''' Hash a sequence of key parts: numpy arrays are hashed by content, anything else by repr
+        '''
+        hasher = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                array_fingerprint(part, hasher)
+            else:
+                hasher.update(repr(part).encode())
+            hasher.update(b"\x00")
+        return hasher.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def get(self, key):
+        ''' The cached result for key, or None
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(self.entries[key])
+        if self.cache_dir is not None and os.path.exists(self._file(key)):
+            with open(self._file(key), "rb") as f:
+                value = pickle.load(f)
+            self._remember(key, value)
+            self.hits += 1
+            return copy.deepcopy(value)
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = copy.deepcopy(value)
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            # write to a temporary file first so concurrent readers never see a partial pickle
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp, self._file(key))
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        ''' Drop the in-memory entries (the on-disk store is kept)
+        '''
+        self.entries.clear()
+
+
+def search_key(searcher, method, query, **params):
+    ''' Cache key of a search: the searcher's cache_scope() (the lake and index it searches),
+        the method name, the query column vectors and the other arguments of the call
+    '''
+    return ResultCache.key(searcher.cache_scope(), method, np.asarray(query[1]), sorted(params.items()))
+
+
+def cached_search(method):
+    ''' Decorator for searcher methods of the form method(self, enc, query, K, ...)
+        Results are looked up in self.cache (a ResultCache, or None to disable caching) by
+        search_key(), with defaults filled in so positional and keyword calls share entries.
+    '''
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self, "cache", None) is None:
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        del params["self"]
+        key = search_key(self, method.__name__, params.pop("query"), **params)
+        result = self.cache.get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            # results cut short by a time budget are not reused (ANN searchers return (scores, # candidates))
+            scores = result[0] if isinstance(result, tuple) else result
+            if getattr(scores, "exact", True):
+                self.cache.put(key, result)
+        return result
+    return wrapper
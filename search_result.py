@@ -0,0 +1,9 @@
+class SearchResult(list):
+    ''' Top-K list of (score, table name) pairs returned by a time-budgeted search.
+
+    `exact` is False when the time budget ran out before the search could show that
+    the list is the exact top-K; the list then holds the best tables verified so far.
+    '''
+    def __init__(self, scores=(), exact=True):
+        super(SearchResult, self).__init__(scores)
+        self.exact = exact
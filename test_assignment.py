@@ -0,0 +1,57 @@
+import numpy as np
+
+from assignment import max_weight_matching, graph_components, _scipy_score, DECOMPOSE_MIN_SIZE
+
+
+def generate_sparse_graph(rng, threshold=0.3):
+    # thresholded similarity graph of 8-16 rows and columns made of several blocks, some of them a single
+    # edge, with shuffled rows and columns
+    numRows, numCols = rng.randint(8, 17), rng.randint(8, 17)
+    graph = np.zeros((numRows, numCols))
+    row, col = 0, 0
+    while row < numRows and col < numCols:
+        if rng.rand() < 0.3:
+            height, width = 1, 1
+        else:
+            height = min(rng.randint(1, 5), numRows - row)
+            width = min(rng.randint(1, 5), numCols - col)
+        block = rng.rand(height, width)
+        block[block <= threshold] = 0.0
+        if not block.any():
+            block[rng.randint(height), rng.randint(width)] = threshold + (1 - threshold) * rng.rand()
+        graph[row:row + height, col:col + width] = block
+        row, col = row + height, col + width
+    return graph[rng.permutation(numRows)][:, rng.permutation(numCols)]
+
+
+def test_decomposed_matching_matches_full_assignment():
+    rng = np.random.RandomState(3)
+    decomposed = 0
+    for _ in range(400):
+        graph = generate_sparse_graph(rng)
+        hit = graph[graph.any(axis=1)][:, graph.any(axis=0)]
+        if min(hit.shape) >= DECOMPOSE_MIN_SIZE['munkres'] and len(graph_components(hit)) > 1:
+            decomposed += 1
+        assert np.isclose(max_weight_matching(graph, 'munkres'), _scipy_score(graph)), graph
+    # most graphs take the component path
+    assert decomposed > 200, decomposed
+
+
+def test_graph_components_cover_every_edge():
+    rng = np.random.RandomState(4)
+    for _ in range(100):
+        graph = generate_sparse_graph(rng)
+        covered = np.zeros(graph.shape, dtype=bool)
+        for rows, cols in graph_components(graph):
+            covered[np.ix_(rows, cols)] = True
+        assert covered[graph > 0].all()
+        # components share no row or column
+        rows = np.concatenate([rows for rows, _ in graph_components(graph)])
+        cols = np.concatenate([cols for _, cols in graph_components(graph)])
+        assert len(np.unique(rows)) == len(rows) and len(np.unique(cols)) == len(cols)
+
+
+if __name__ == '__main__':
+    test_decomposed_matching_matches_full_assignment()
+    test_graph_components_cover_every_edge()
+    print("assignment tests passed")
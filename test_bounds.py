@@ -1,15 +1,59 @@
-import pickle
+import numpy as np
 
-from bounds import verify, upper_bound_bm, lower_bound_bm
+from lake import ColumnStore
 
+from bounds import verify, verify_tables, similarity_graph, matching_bounds, get_edges, lower_bound_bm, upper_bound_bm
 
-tables = pickle.load(open("starmie_datalake_columns_santos.pkl","rb"))
-queries = pickle.load(open("starmie_query_columns_santos.pkl","rb"))
 
-query = queries[4]
-threshold = 0.6
-for table in tables:
-    lb = lower_bound_bm(table[1], query[1], threshold)
-    ub = upper_bound_bm(table[1], query[1], threshold)
-    true = verify(table[1], query[1], threshold)
-    print("lower bound: ", lb,"upper bound: ", ub, "true value: ", true)
\ No newline at end of file
+def generate_tables(rng, num_pairs, ndim=16):
+    # random (query, data lake table) pairs with 1-9 columns each
+    pairs = []
+    for _ in range(num_pairs):
+        table1 = rng.randn(rng.randint(1, 10), ndim)
+        table2 = rng.randn(rng.randint(1, 10), ndim)
+        pairs.append((table1, table2))
+    return pairs
+
+
+def test_bounds_bracket_exact_score():
+    rng = np.random.RandomState(0)
+    for threshold in [0.0, 0.1, 0.3, 0.6]:
+        for table1, table2 in generate_tables(rng, 200):
+            lb, ub = matching_bounds(similarity_graph(table1, table2, threshold))
+            true = verify(table1, table2, threshold, solver='munkres')
+            assert lb <= true + 1e-9, (lb, true)
+            assert true <= ub + 1e-9, (true, ub)
+
+
+def test_bounds_match_list_implementation():
+    # matching_bounds gives the same values as lower_bound_bm/upper_bound_bm run on their own node sets
+    rng = np.random.RandomState(1)
+    for table1, table2 in generate_tables(rng, 200):
+        edges, nodes1, nodes2 = get_edges(table1, table2, 0.1)
+        lb = lower_bound_bm(edges, set(nodes1), set(nodes2))
+        ub = upper_bound_bm(edges, set(nodes1), set(nodes2))
+        bounds = matching_bounds(similarity_graph(table1, table2, 0.1))
+        assert np.allclose(bounds, (lb, ub))
+
+
+def test_bounds_empty_graph():
+    assert matching_bounds(np.zeros((3, 4))) == (0.0, 0.0)
+
+
+def test_verify_tables_matches_verify():
+    rng = np.random.RandomState(2)
+    query = rng.randn(4, 16)
+    tables = [("t%d" % idx, table) for idx, (_, table) in enumerate(generate_tables(rng, 300))]
+    store = ColumnStore.from_tables(tables)
+    for threshold in [0.0, 0.1, 0.3]:
+        scores = verify_tables(query, store, np.arange(len(store)), threshold)
+        expected = [verify(query, store.table(idx), threshold, solver='munkres') for idx in range(len(store))]
+        assert np.allclose(scores, expected, atol=1e-5)
+
+
+if __name__ == '__main__':
+    test_bounds_bracket_exact_score()
+    test_bounds_match_list_implementation()
+    test_bounds_empty_graph()
+    test_verify_tables_matches_verify()
+    print("bounds tests passed")
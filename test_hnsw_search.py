@@ -5,6 +5,8 @@ import argparse
 import time
 import numpy as np
 from hnsw_search import HNSWSearcher
+from result_cache import ResultCache
+from lake import load_tables
 from checkPrecisionRecall import saveDictionaryAsPickleFile, calcMetrics
 
 if __name__ == '__main__':
@@ -15,15 +17,23 @@ if __name__ == '__main__':
     parser.add_argument("--single_column", dest="single_column", action="store_true")
     parser.add_argument("--K", type=int, default=10)
     parser.add_argument("--scal", type=float, default=1.00)
+    # seed of the table sample for --scal < 1: with a seed, smaller scales keep a subset of the tables of larger ones
+    parser.add_argument("--seed", type=int, default=None)
     # parser.add_argument("--N", type=int, default=10)
     # parser.add_argument("--threshold", type=float, default=0.7)
+    # assignment backend used by exact verification: "scipy" (fast) or "munkres" (reference)
+    parser.add_argument("--solver", type=str, default="scipy", choices=['scipy', 'munkres'])
+    # per-query search time in seconds: return the best results found when it runs out (no limit if not set)
+    parser.add_argument("--time_budget", type=float, default=None)
+    # directory of the persistent search result cache, shared across runs (no cache if not set)
+    parser.add_argument("--cache_dir", type=str, default=None)
     # mlflow tag
     parser.add_argument("--mlflow_tag", type=str, default=None)
 
     hp = parser.parse_args()
 
     # mlflow logging
-    for variable in ["encoder", "benchmark", "single_column", "run_id", "K", "scal"]:
+    for variable in ["encoder", "benchmark", "single_column", "run_id", "K", "scal", "seed", "solver"]:
         mlflow.log_param(variable, getattr(hp, variable))
 
     if hp.mlflow_tag:
@@ -66,17 +76,20 @@ if __name__ == '__main__':
             index_path = "data/"+dataFolder+"/indexes/hnsw_open_data_"+str(table_id)+"_singleCol.bin"
 
     # Call HNSWSearcher from hnsw_search.py
-    searcher = HNSWSearcher(table_path, index_path, hp.scal)
-    queries = pickle.load(open(query_path,"rb"))
+    cache = ResultCache(cache_dir=hp.cache_dir) if hp.cache_dir else None
+    searcher = HNSWSearcher(table_path, index_path, hp.scal, solver=hp.solver, cache=cache, seed=hp.seed)
+    queries = load_tables(query_path)
 
     start_time = time.time()
     returnedResults = {}
     avgNumResults = []
     query_times = []
+    numInexact = 0
 
     for q in queries:
         query_start_time = time.time()
-        res, scoreLength = searcher.topk(encoder,q,K, N=N,threshold=threshold) #N=10,
+        res, scoreLength = searcher.topk(encoder,q,K, N=N,threshold=threshold,time_budget=hp.time_budget) #N=10,
+        numInexact += not getattr(res, "exact", True)
         returnedResults[q[0]] = [r[1] for r in res]
         avgNumResults.append(scoreLength)
         query_times.append(time.time() - query_start_time)
@@ -85,6 +98,8 @@ if __name__ == '__main__':
     print("Average QUERY TIME: %s seconds " % (sum(query_times)/len(query_times)))
     print("10th percentile: ", np.percentile(query_times, 10), " 90th percentile: ", np.percentile(query_times, 90))
     print("--- Total Query Time: %s seconds ---" % (time.time() - start_time))
+    if hp.time_budget is not None:
+        print("%d of %d queries ran out of the time budget" % (numInexact, len(queries)))
 
     # santosLarge and WDC benchmarks are used for efficiency
     if hp.benchmark == 'santosLarge' or hp.benchmark == 'wdc':
@@ -5,6 +5,8 @@ import argparse
 import mlflow
 import numpy as np
 from lsh_search import LSHSearcher
+from result_cache import ResultCache
+from lake import load_tables
 from checkPrecisionRecall import saveDictionaryAsPickleFile, calcMetrics
 
 if __name__ == '__main__':
@@ -17,8 +19,28 @@ if __name__ == '__main__':
     parser.add_argument("--num_table", type=int, default=100)
     parser.add_argument("--K", type=int, default=10)
     parser.add_argument("--scal", type=float, default=1.00)
+    # seed of the table sample for --scal < 1: with a seed, smaller scales keep a subset of the tables of larger ones
+    parser.add_argument("--seed", type=int, default=None)
     # parser.add_argument("--N", type=int, default=10)
     # parser.add_argument("--threshold", type=float, default=0.7)
+    # assignment backend used by exact verification: "scipy" (fast) or "munkres" (reference)
+    parser.add_argument("--solver", type=str, default="scipy", choices=['scipy', 'munkres'])
+    # how the LSH hyperplanes are chosen: "random", or fitted on --fit_sample lake columns ("orthogonal", "itq")
+    parser.add_argument("--hashing", type=str, default="random", choices=['random', 'orthogonal', 'itq'])
+    parser.add_argument("--fit_sample", type=int, default=10000)
+    # number of threads building the LSH index, each hashing into a share of the hash tables
+    parser.add_argument("--num_threads", type=int, default=1)
+    # multi-probe: probe the buckets within --radius bits of each query column's code, only the --num_probes
+    # most likely of them per hash table if set
+    parser.add_argument("--radius", type=int, default=1)
+    parser.add_argument("--num_probes", type=int, default=None)
+    # number of index candidates per query column reranked by similarity, keeping those whose LSH signatures
+    # are closest in Hamming distance (all candidates if not set)
+    parser.add_argument("--hamming_candidates", type=int, default=None)
+    # per-query search time in seconds: return the best results found when it runs out (no limit if not set)
+    parser.add_argument("--time_budget", type=float, default=None)
+    # directory of the persistent search result cache, shared across runs (no cache if not set)
+    parser.add_argument("--cache_dir", type=str, default=None)
     # mlflow tag
     parser.add_argument("--mlflow_tag", type=str, default=None)
 
@@ -26,7 +48,7 @@ if __name__ == '__main__':
 
 
     # mlflow logging
-    for variable in ["encoder", "num_func", "num_table", "benchmark", "K", "run_id", "scal"]:
+    for variable in ["encoder", "num_func", "num_table", "benchmark", "K", "run_id", "scal", "seed", "solver", "hashing", "fit_sample", "radius", "num_probes", "hamming_candidates"]:
         mlflow.log_param(variable, getattr(hp, variable))
 
     if hp.mlflow_tag:
@@ -56,33 +78,38 @@ if __name__ == '__main__':
         N = 50
         query_path = "data/"+dataFolder+"/"+encoder+"_query.pkl"
         table_path = "data/"+dataFolder+"/"+encoder+"_datalake.pkl"
-        index_path = "data/"+dataFolder+"/indexes/lsh_"+encoder+".bin"
+        index_path = "data/"+dataFolder+"/indexes/lsh_"+encoder+"_"+str(hp.scal)+".lsh"
     else:
         N = 4
         table_id = hp.run_id
         table_path = "data/"+dataFolder+"/vectors/cl_datalake_"+sampAug+"_column_"+str(table_id)+".pkl"
         query_path = "data/"+dataFolder+"/vectors/cl_query_"+sampAug+"_column_"+str(table_id)+".pkl"
-        index_path = "data/"+dataFolder+"/indexes/lsh_open_data_"+str(table_id)+"_"+str(hp.scal)+".bin"
+        index_path = "data/"+dataFolder+"/indexes/lsh_open_data_"+str(table_id)+"_"+str(hp.scal)+".lsh"
         if singleCol:
             N = 50
             table_path = "data/"+dataFolder+"/vectors/cl_datalake_"+singSampAug+"_column_"+str(table_id)+"_singleCol.pkl"
             query_path = "data/"+dataFolder+"/vectors/cl_query_"+singSampAug+"_column_"+str(table_id)+"_singleCol.pkl"
-            index_path = "data/"+dataFolder+"/indexes/lsh_open_data_"+str(table_id)+"_singleCol.bin"
+            index_path = "data/"+dataFolder+"/indexes/lsh_open_data_"+str(table_id)+"_"+str(hp.scal)+"_singleCol.lsh"
 
     num_hash_func = hp.num_func
     num_hash_table = hp.num_table
     # Call LSHSearcher from lsh_search.py
-    searcher = LSHSearcher(table_path, num_hash_func, num_hash_table, hp.scal)
+    cache = ResultCache(cache_dir=hp.cache_dir) if hp.cache_dir else None
+    searcher = LSHSearcher(table_path, num_hash_func, num_hash_table, hp.scal, solver=hp.solver, cache=cache, seed=hp.seed,
+                           hamming_candidates=hp.hamming_candidates, radius=hp.radius, num_probes=hp.num_probes,
+                           index_path=index_path, num_threads=hp.num_threads, hashing=hp.hashing, fit_sample=hp.fit_sample)
     # Load the query from the pickle file
-    queries = pickle.load(open(query_path,"rb"))
+    queries = load_tables(query_path)
     start_time = time.time()
     returnedResults = {}
     avgNumResults = []
     query_times = []
+    numInexact = 0
 
     for q in queries:
         query_start_time = time.time()
-        res, numCalls = searcher.topk(encoder,q,K,N=N,threshold=threshold)
+        res, numCalls = searcher.topk(encoder,q,K,N=N,threshold=threshold,time_budget=hp.time_budget)
+        numInexact += not getattr(res, "exact", True)
         returnedResults[q[0]] = [r[1] for r in res]
         avgNumResults.append(numCalls)
         query_times.append(time.time() - query_start_time)
@@ -91,6 +118,8 @@ if __name__ == '__main__':
     print("Average QUERY TIME: %s seconds " % (sum(query_times)/len(query_times)))
     print("10th percentile: ", np.percentile(query_times, 10), " 90th percentile: ", np.percentile(query_times, 90))
     print("--- Total Query Time: %s seconds ---" % (time.time() - start_time))
+    if hp.time_budget is not None:
+        print("%d of %d queries ran out of the time budget" % (numInexact, len(queries)))
 
     # santosLarge and WDC benchmarks are used for efficiency
     if hp.benchmark == 'santosLarge' or hp.benchmark == 'wdc':
@@ -4,7 +4,9 @@ import pickle
 import argparse
 import mlflow
 from naive_search import NaiveSearcher
-from checkPrecisionRecall import saveDictionaryAsPickleFile, calcMetrics
+from result_cache import ResultCache
+from lake import load_tables
+from checkPrecisionRecall import saveDictionaryAsPickleFile, calcMetrics, calcRecallVsExact
 import time
 
 def generate_random_table(nrow, ncol):
@@ -50,7 +52,12 @@ if __name__ == '__main__':
     parser.add_argument("--augment_op", type=str, default="drop_col")
     parser.add_argument("--sample_meth", type=str, default="tfidf_entity")
     # matching is the type of matching
-    parser.add_argument("--matching", type=str, default='exact') #exact or bounds (or greedy)
+    parser.add_argument("--matching", type=str, default='exact') #exact, ordered, bounds or rerank (or greedy)
+    # For rerank matching: number of tables verified exactly after ranking the lake by a cheap score
+    parser.add_argument("--rerank_budget", type=int, default=100)
+    parser.add_argument("--rerank_scorer", type=str, default='bound', choices=['bound', 'colmax'])
+    # also run exact search and report the recall of the chosen matching against it
+    parser.add_argument("--report_recall", dest="report_recall", action="store_true")
     parser.add_argument("--table_order", type=str, default="column")
     parser.add_argument("--run_id", type=int, default=0)
     parser.add_argument("--single_column", dest="single_column", action="store_true")
@@ -59,15 +66,29 @@ if __name__ == '__main__':
     parser.add_argument("--analysis", type=str, default='col') # 'col', 'row', 'numeric'
     parser.add_argument("--K", type=int, default=10)
     parser.add_argument("--threshold", type=float, default=0.6)
+    # For batched exact search: number of queries scanned against the lake together (1 = one at a time)
+    parser.add_argument("--query_batch", type=int, default=1)
+    # number of worker processes sharing the data lake for exact and bounds search (1 = single process)
+    parser.add_argument("--num_workers", type=int, default=1)
     # For Scalability experiments
     parser.add_argument("--scal", type=float, default=1.00)
+    # seed of the table sample for --scal < 1: with a seed, smaller scales keep a subset of the tables of larger ones
+    parser.add_argument("--seed", type=int, default=None)
+    # assignment backend used by exact verification: "scipy" (fast) or "munkres" (reference)
+    parser.add_argument("--solver", type=str, default="scipy", choices=['scipy', 'munkres'])
+    # per-query search time in seconds: return the best results found when it runs out (no limit if not set)
+    parser.add_argument("--time_budget", type=float, default=None)
+    # directory of the persistent search result cache, shared across runs (no cache if not set)
+    parser.add_argument("--cache_dir", type=str, default=None)
     # mlflow tag
     parser.add_argument("--mlflow_tag", type=str, default=None)
 
     hp = parser.parse_args()
+    if hp.time_budget is not None and (hp.matching not in ['exact', 'ordered'] or hp.query_batch > 1):
+        parser.error("--time_budget only applies to --matching exact or ordered, one query at a time (--query_batch 1)")
 
     # mlflow logging
-    for variable in ["encoder", "benchmark", "augment_op", "sample_meth", "matching", "table_order", "run_id", "single_column", "K", "threshold", "scal"]:
+    for variable in ["encoder", "benchmark", "augment_op", "sample_meth", "matching", "table_order", "run_id", "single_column", "K", "threshold", "scal", "seed", "solver", "rerank_budget", "rerank_scorer"]:
         mlflow.log_param(variable, getattr(hp, variable))
 
     if hp.mlflow_tag:
@@ -90,12 +111,11 @@ if __name__ == '__main__':
         table_path = "data/"+dataFolder+"/"+hp.encoder+"_datalake.pkl"
 
     # Load the query file
-    qfile = open(query_path,"rb")
-    queries = pickle.load(qfile)
+    queries = load_tables(query_path)
     print("Number of queries: %d" % (len(queries)))
-    qfile.close()
     # Call NaiveSearcher, which has linear search and bounds search, from naive_search.py
-    searcher = NaiveSearcher(table_path, hp.scal)
+    cache = ResultCache(cache_dir=hp.cache_dir) if hp.cache_dir else None
+    searcher = NaiveSearcher(table_path, hp.scal, solver=hp.solver, num_workers=hp.num_workers, cache=cache, seed=hp.seed)
     returnedResults = {}
     start_time = time.time()
     # For error analysis of tables
@@ -105,27 +125,58 @@ if __name__ == '__main__':
     queries.sort(key = lambda x: x[0])
     query_times = []
     qCount = 0
-
-    for query in queries:
-            qCount += 1
-            if qCount % 10 == 0:
-                print("Processing query ",qCount, " of ", len(queries), " total queries.")
-        # if query[0] in bucket:
-            query_start_time = time.time()
-            if hp.matching == 'exact':
-                qres = searcher.topk(hp.encoder, query, hp.K, threshold=hp.threshold)
-            else: # Bounds matching
-                qres = searcher.topk_bounds(hp.encoder, query, hp.K, threshold=hp.threshold)
-            res = []
-            for tpl in qres:
-                tmp = (tpl[0],tpl[1])
-                res.append(tmp)
-            returnedResults[query[0]] = [r[1] for r in res]
-            query_times.append(time.time() - query_start_time)
+    numInexact = 0
+
+    if hp.matching == 'exact' and hp.query_batch > 1:
+        # Batched exact search: one scan of the lake per batch of queries
+        for i in range(0, len(queries), hp.query_batch):
+            batch = queries[i:i+hp.query_batch]
+            print("Processing queries ", i+1, "-", i+len(batch), " of ", len(queries), " total queries.")
+            batch_start_time = time.time()
+            batch_res = searcher.topk_batch(hp.encoder, batch, hp.K, threshold=hp.threshold)
+            batch_time = time.time() - batch_start_time
+            for query, qres in zip(batch, batch_res):
+                returnedResults[query[0]] = [r[1] for r in qres]
+                query_times.append(batch_time / len(batch))
+    else:
+        for query in queries:
+                qCount += 1
+                if qCount % 10 == 0:
+                    print("Processing query ",qCount, " of ", len(queries), " total queries.")
+            # if query[0] in bucket:
+                query_start_time = time.time()
+                if hp.matching == 'exact':
+                    qres = searcher.topk(hp.encoder, query, hp.K, threshold=hp.threshold, time_budget=hp.time_budget)
+                elif hp.matching == 'ordered': # Exact, verifying tables by decreasing upper bound
+                    qres = searcher.topk_ordered(hp.encoder, query, hp.K, threshold=hp.threshold, time_budget=hp.time_budget)
+                elif hp.matching == 'rerank': # Cheap scores for the whole lake, exact matching for the best rerank_budget tables
+                    qres = searcher.topk_rerank(hp.encoder, query, hp.K, threshold=hp.threshold,
+                                                rerank_budget=hp.rerank_budget, scorer=hp.rerank_scorer)
+                else: # Bounds matching
+                    qres = searcher.topk_bounds(hp.encoder, query, hp.K, threshold=hp.threshold)
+                res = []
+                for tpl in qres:
+                    tmp = (tpl[0],tpl[1])
+                    res.append(tmp)
+                returnedResults[query[0]] = [r[1] for r in res]
+                query_times.append(time.time() - query_start_time)
+                numInexact += not getattr(qres, "exact", True)
 
     print("Average QUERY TIME: %s seconds " % (sum(query_times)/len(query_times)))
     print("10th percentile: ", np.percentile(query_times, 10), " 90th percentile: ", np.percentile(query_times, 90))
     print("--- Total Query Time: %s seconds ---" % (time.time() - start_time))
+    if hp.time_budget is not None:
+        print("%d of %d queries ran out of the time budget" % (numInexact, len(queries)))
+
+    if hp.report_recall:
+        # exact top-K of every query (not timed), to measure what the chosen matching gives up
+        exactResults = {}
+        for query in queries:
+            exactResults[query[0]] = [r[1] for r in searcher.topk(hp.encoder, query, hp.K, threshold=hp.threshold)]
+        recall = calcRecallVsExact(returnedResults, exactResults)
+        print("Recall@%d against exact search: %.4f" % (hp.K, recall))
+        mlflow.log_metric("recall_vs_exact", recall)
+    searcher.close()
 
     # santosLarge and WDC benchmarks are used for efficiency
     if hp.benchmark == 'santosLarge' or hp.benchmark == 'wdc':